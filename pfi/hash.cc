@@ -1,3 +1,4 @@
+#include <stddef.h>
 #include <stdint.h>
 #include <string.h>
 #include "spooky.h"
@@ -8,4 +9,10 @@ uint64_t hash_string(const char *str) {
    return SpookyHash::Hash64(str, strlen(str), 0);
 }
 
+void hash_strings(const char **strs, size_t n, uint64_t *out) {
+   for (size_t i = 0; i < n; ++i) {
+      out[i] = hash_string(strs[i]);
+   }
+}
+
 } // extern "C"
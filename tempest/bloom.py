@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Bloom filter over the (src, dst) keys of a path file, used by PFI to answer
+definite misses without touching the index.
+
+Bit positions come from the key's 64-bit SpookyHash (the same value PFI
+probes with) by double hashing: position j is (h1 + j * h2) % num_bits, where
+h1 and h2 are the low and high 32 bits of the hash.
+
+File layout (little-endian):
+    magic       8 bytes, MAGIC
+    version     uint32
+    num_hashes  uint32
+    num_bits    uint64
+    num_keys    uint64
+    bits        ceil(num_bits / 8) bytes
+"""
+
+import logging
+import math
+import struct
+
+import numpy
+
+from . import pfi_builder
+from . import spookyhash
+
+MAGIC = b"PFIBLOOM"
+VERSION = 1
+
+HEADER_FORMAT = "<8sIIQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+def optimal_parameters(num_keys, false_positive_rate):
+    """
+    Returns (num_bits, num_hashes) for a filter holding num_keys keys at the
+    given false positive rate.
+    """
+    num_keys = max(num_keys, 1)
+    num_bits = int(math.ceil(-num_keys * math.log(false_positive_rate) /
+                             (math.log(2) ** 2)))
+    num_hashes = max(1, int(round(num_bits / num_keys * math.log(2))))
+    return num_bits, num_hashes
+
+class BloomFilter(object):
+    def __init__(self, num_bits, num_hashes, bits=None, num_keys=0):
+        self._num_bits = num_bits
+        self._num_hashes = num_hashes
+        self._num_keys = num_keys
+
+        if bits is None:
+            bits = numpy.zeros((num_bits + 7) // 8, dtype=numpy.uint8)
+        self._bits = bits
+
+    def _positions(self, hashes):
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        h1 = hashes & numpy.uint64(0xffffffff)
+        h2 = hashes >> numpy.uint64(32)
+        num_bits = numpy.uint64(self._num_bits)
+        for j in range(0, self._num_hashes):
+            yield (h1 + numpy.uint64(j) * h2) % num_bits
+
+    def add_hashes(self, hashes):
+        for positions in self._positions(hashes):
+            masks = (numpy.uint8(1) <<
+                     (positions & numpy.uint64(7)).astype(numpy.uint8))
+            numpy.bitwise_or.at(self._bits, positions >> numpy.uint64(3),
+                                masks)
+        self._num_keys += len(hashes)
+
+    def might_contain(self, hash_value):
+        h1 = hash_value & 0xffffffff
+        h2 = hash_value >> 32
+        for j in range(0, self._num_hashes):
+            position = (h1 + j * h2) % self._num_bits
+            if not (self._bits[position >> 3] >> (position & 7)) & 1:
+                return False
+        return True
+
+    def might_contain_hashes(self, hashes):
+        """
+        Vectorized might_contain(); returns a numpy bool array.
+        """
+        result = numpy.ones(len(hashes), dtype=bool)
+        for positions in self._positions(hashes):
+            bytes_ = self._bits[(positions >> numpy.uint64(3)).astype(
+                numpy.int64)]
+            result &= ((bytes_ >> (positions & numpy.uint64(7)).astype(
+                numpy.uint8)) & 1).astype(bool)
+        return result
+
+    def save(self, bloom_filename):
+        with open(bloom_filename, "wb") as bloom_file:
+            bloom_file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION,
+                                         self._num_hashes, self._num_bits,
+                                         self._num_keys))
+            self._bits.tofile(bloom_file)
+
+    @staticmethod
+    def load(bloom_filename):
+        """
+        Opens a saved filter; the bit array is memory-mapped read-only.
+        """
+        with open(bloom_filename, "rb") as bloom_file:
+            magic, version, num_hashes, num_bits, num_keys =\
+                struct.unpack(HEADER_FORMAT, bloom_file.read(HEADER_SIZE))
+
+        if magic != MAGIC:
+            raise ValueError("Not a PFI Bloom filter")
+        if version != VERSION:
+            raise ValueError("Unsupported Bloom filter version {}".format(
+                version))
+
+        bits = numpy.memmap(bloom_filename, dtype=numpy.uint8, mode="r",
+                            offset=HEADER_SIZE, shape=((num_bits + 7) // 8,))
+        return BloomFilter(num_bits, num_hashes, bits, num_keys)
+
+def build_bloom_filter(path_filename, bloom_filename,
+                       false_positive_rate=0.01, chunk_lines=1 << 20):
+    """
+    Builds a Bloom filter over every (src, dst) key in path_filename and
+    writes it to bloom_filename.
+    """
+    num_lines = pfi_builder.path_file_stats(path_filename)[0]
+    num_bits, num_hashes = optimal_parameters(num_lines, false_positive_rate)
+
+    logging.info("Bloom filter bits:\t{}".format(num_bits))
+    logging.info("Bloom filter hashes:\t{}".format(num_hashes))
+
+    bloom_filter = BloomFilter(num_bits, num_hashes)
+
+    for keys, _ in pfi_builder.read_key_chunks(path_filename, chunk_lines):
+        bloom_filter.add_hashes(spookyhash.hash64_array(keys))
+
+    bloom_filter.save(bloom_filename)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Sorted index from datetimes to the files of a directory whose names carry a
+timestamp, such as network state files.  Lookups are binary searches instead
+of listing the directory and parsing every filename.
+
+DatetimeIndex.for_directory() keeps one index per (directory, regex, time
+format) for the life of the process and can persist it to an index file.
+Both are rebuilt when the directory's modification time changes, i.e. when
+files are added, removed or renamed, so an index file must not be written
+directly into the directory it indexes (a subdirectory is fine).  An index
+file is tab-separated text: a header line with the directory's st_mtime_ns,
+then one "<datetime string>\t<basename>" line per file.
+"""
+
+import bisect
+import datetime
+import os
+
+_indexes = dict()
+
+class DatetimeIndex(object):
+    def __init__(self, datetimes, filenames):
+        """
+        datetimes and filenames are parallel lists sorted by datetime.
+        """
+        self._datetimes = datetimes
+        self._filenames = filenames
+
+    def __len__(self):
+        return len(self._datetimes)
+
+    def items(self):
+        return zip(self._datetimes, self._filenames)
+
+    def exact(self, dt):
+        """
+        Returns the filename for datetime dt, or None.
+        """
+        idx = bisect.bisect_left(self._datetimes, dt)
+        if idx < len(self._datetimes) and self._datetimes[idx] == dt:
+            return self._filenames[idx]
+        return None
+
+    def nearest_before(self, dt):
+        """
+        Returns (datetime, filename) for the latest datetime <= dt, or None.
+        """
+        idx = bisect.bisect_right(self._datetimes, dt)
+        if idx == 0:
+            return None
+        return self._datetimes[idx - 1], self._filenames[idx - 1]
+
+    def range(self, start_dt, end_dt):
+        """
+        Returns the filenames with start_dt <= datetime < end_dt, in datetime
+        order.
+        """
+        start = bisect.bisect_left(self._datetimes, start_dt)
+        end = bisect.bisect_left(self._datetimes, end_dt)
+        return self._filenames[start:end]
+
+    @staticmethod
+    def build(directory, compiled_regex, time_format):
+        """
+        Indexes the files in directory whose absolute path matches
+        compiled_regex; group 1 of the match is parsed with time_format.
+        """
+        dir_path = os.path.abspath(directory)
+        entries = []
+
+        with os.scandir(dir_path) as dir_entries:
+            for entry in dir_entries:
+                filename = dir_path + "/" + entry.name
+                match = compiled_regex.match(filename)
+                if match is not None and entry.is_file():
+                    entries.append((datetime.datetime.strptime(match.group(1),
+                                                               time_format),
+                                    filename))
+
+        entries.sort()
+        return DatetimeIndex([dt for dt, _ in entries],
+                             [filename for _, filename in entries])
+
+    @staticmethod
+    def for_directory(directory, compiled_regex, time_format,
+                      index_filename=None):
+        """
+        Returns the index of directory, reusing the one built earlier in this
+        process or stored in index_filename if the directory has not changed
+        since.
+        """
+        dir_path = os.path.abspath(directory)
+        if index_filename is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(index_filename)),
+                        exist_ok=True)
+        dir_mtime = os.stat(dir_path).st_mtime_ns
+        key = (dir_path, compiled_regex.pattern, time_format)
+
+        cached = _indexes.get(key)
+        if cached is not None and cached[0] == dir_mtime:
+            index = cached[1]
+            if (index_filename is not None and
+                DatetimeIndex._stored_mtime(index_filename) != dir_mtime):
+                index._save(index_filename, dir_mtime, time_format)
+            return index
+
+        index = None
+        if index_filename is not None and os.path.exists(index_filename):
+            index = DatetimeIndex._load(index_filename, dir_path, dir_mtime,
+                                        time_format)
+
+        if index is None:
+            index = DatetimeIndex.build(dir_path, compiled_regex, time_format)
+            if index_filename is not None:
+                index._save(index_filename, dir_mtime, time_format)
+
+        _indexes[key] = (dir_mtime, index)
+        return index
+
+    @staticmethod
+    def _stored_mtime(index_filename):
+        """
+        Returns the directory mtime recorded in an index file, or None if
+        there is no readable index file.
+        """
+        try:
+            with open(index_filename, "r") as index_file:
+                return int(index_file.readline())
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, index_filename, dir_mtime, time_format):
+        tmp_filename = index_filename + ".tmp"
+        with open(tmp_filename, "w") as index_file:
+            index_file.write("{}\n".format(dir_mtime))
+            for dt, filename in self.items():
+                index_file.write("{}\t{}\n".format(dt.strftime(time_format),
+                                                   os.path.basename(filename)))
+        os.replace(tmp_filename, index_filename)
+
+    @staticmethod
+    def _load(index_filename, dir_path, dir_mtime, time_format):
+        """
+        Returns the stored index, or None if it is stale.
+        """
+        if DatetimeIndex._stored_mtime(index_filename) != dir_mtime:
+            return None
+
+        with open(index_filename, "r") as index_file:
+            index_file.readline()
+
+            datetimes, filenames = [], []
+            for line in index_file:
+                datetime_str, basename = line.rstrip("\n").split("\t")
+                datetimes.append(datetime.datetime.strptime(datetime_str,
+                                                            time_format))
+                filenames.append(dir_path + "/" + basename)
+
+        return DatetimeIndex(datetimes, filenames)
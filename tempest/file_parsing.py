@@ -1,16 +1,16 @@
 #!/usr/bin/env python3
 
-import datetime
+import collections
+import itertools
 import multiprocessing
-import os
-import re
 
 from .tor import relays
-from . import util
 
 def parallel_load_nsf(args):
-    file_date, filename = args
+    file_date, filename, project = args
     network_state = relays.fat_network_state(filename)
+    if project is not None:
+        network_state = project(network_state)
     return (file_date, network_state)
 
 def read_clique_file(clique_ases_filename):
@@ -45,42 +45,61 @@ def read_map_ases(asrel_filename):
 
     return ases
 
-def nsf_datetime_to_filename(nsf_dir):
-    nsf_datetime_regex =\
-        re.compile(".*/([0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2})")
+def nsf_datetime_to_filename(nsf_dir, persist_index=False):
+    return dict(relays.nsf_index(nsf_dir, persist_index).items())
 
-    datetime_to_nsf_filename = dict()
-
-    for nsf_filename in util.get_all_filenames_in_directory(nsf_dir):
-        nsf_datetime_str = nsf_datetime_regex.match(nsf_filename).group(1)
-        nsf_datetime = datetime.datetime.strptime(nsf_datetime_str,
-                                                  "%Y-%m-%d-%H-%M-%S")
-        datetime_to_nsf_filename[nsf_datetime] = nsf_filename
-
-    return datetime_to_nsf_filename
-
-def read_nsf_files_by_time(nsf_dir, num_procs):
-    datetime_regex =\
-        re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}")
-
-    nsf_filenames = [fn for fn in os.listdir(nsf_dir) if
-                     os.path.isfile(os.path.join(nsf_dir, fn))]
-
-    arg_list = []
-
-    for filename in nsf_filenames:
-        date_string = datetime_regex.match(filename).group()
-        file_date = datetime.datetime.strptime(date_string, "%Y-%m-%d-%H-%M-%S")
-        arg_list.append((file_date, os.path.join(nsf_dir, filename)))
+def read_nsf_files_by_time(nsf_dir, num_procs, project=None,
+                           persist_index=False):
+    """
+    Returns a dict mapping datetime to network state (or its projection) for
+    every network state file in nsf_dir; see iter_nsf_files_by_time().
+    """
+    return dict(iter_nsf_files_by_time(nsf_dir, num_procs, project=project,
+                                       persist_index=persist_index))
 
-    pool = multiprocessing.Pool(num_procs)
-    results = pool.map(parallel_load_nsf, arg_list)
-    pool.close()
-    pool.join()
+def iter_nsf_files_by_time(nsf_dir, num_procs, project=None, start_date=None,
+                           end_date=None, prefetch=None, persist_index=False):
+    """
+    Yields (datetime, network_state) for the network state files in nsf_dir
+    dated start_date <= datetime < end_date (unbounded if None), in time
+    order.  Files are loaded by a pool of num_procs workers.
 
-    datetime_to_nsf = dict()
+    If project is given, project(network_state) runs in the worker and its
+    result is yielded instead, so only what it returns is pickled back.  It
+    must be a module-level function.
 
-    for dt, nsf in results:
-        datetime_to_nsf[dt] = nsf
+    At most prefetch files (default 2 * num_procs) are loaded or waiting to
+    be consumed at any time, so memory stays bounded however long the
+    directory is.
 
-    return datetime_to_nsf
+    If persist_index is True the directory's index is stored with its
+    sidecars and reused across processes; see relays.nsf_index().
+    """
+    index = relays.nsf_index(nsf_dir, persist_index)
+    entries = [(file_date, filename, project) for file_date, filename in
+               index.items() if
+               (start_date is None or file_date >= start_date) and
+               (end_date is None or file_date < end_date)]
+
+    if num_procs <= 1:
+        for args in entries:
+            yield parallel_load_nsf(args)
+        return
+
+    if prefetch is None:
+        prefetch = 2 * num_procs
+
+    # Pool.imap() would read every task ahead and queue results without
+    # limit, so keep a window of async results in submission order instead.
+    with multiprocessing.Pool(num_procs) as pool:
+        entries = iter(entries)
+        pending = collections.deque(
+            pool.apply_async(parallel_load_nsf, (args,)) for args in
+            itertools.islice(entries, prefetch))
+
+        while len(pending) > 0:
+            result = pending.popleft().get()
+            args = next(entries, None)
+            if args is not None:
+                pending.append(pool.apply_async(parallel_load_nsf, (args,)))
+            yield result
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Compact binary replacement for the ASCII path file written by path_inference.
+
+File layout (all integers little-endian):
+    Header (HEADER_SIZE bytes):
+        magic               8 bytes, MAGIC
+        version             uint32
+        encoding            uint32, ENCODING_UINT32 or ENCODING_VARINT
+        num_asns            uint64
+        asn_table_offset    uint64
+        max_record_size     uint64
+    Records, one per path, starting at HEADER_SIZE:
+        ENCODING_UINT32: uint32 hop count, then one uint32 ASN id per hop
+        ENCODING_VARINT: LEB128 varint hop count, then one varint id per hop
+    ASN table at asn_table_offset:
+        num_asns newline-separated ASCII ASNs; ASN id i is the i-th entry.
+
+ASN ids are assigned by descending frequency, so the common ASNs get the
+shortest varints.  A PFI index built for the ASCII file is converted along
+with it by remapping every bin to the offset of the same path in the binary
+file; hashing and probing are unchanged.
+"""
+
+import array
+import collections
+import logging
+import struct
+
+import numpy
+
+MAGIC = b"PFIPATH\0"
+VERSION = 1
+
+ENCODING_UINT32 = 0
+ENCODING_VARINT = 1
+
+HEADER_FORMAT = "<8sIIQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+PathStoreHeader = collections.namedtuple("PathStoreHeader",
+                                         ["version", "encoding", "num_asns",
+                                          "asn_table_offset",
+                                          "max_record_size"])
+
+_INDEX_CHUNK_BINS = 1 << 22
+
+def _encode_varint(value):
+    buf = bytearray()
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+    return buf
+
+def _decode_varints(buf, pos, count):
+    values = []
+    for _ in range(0, count):
+        value = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values, pos
+
+def encode_path(asn_ids, encoding):
+    """
+    Returns the record bytes for a path given as a list of ASN ids.
+    """
+    if encoding == ENCODING_UINT32:
+        return (struct.pack("<I", len(asn_ids)) +
+                numpy.asarray(asn_ids, dtype="<u4").tobytes())
+    elif encoding == ENCODING_VARINT:
+        buf = _encode_varint(len(asn_ids))
+        for asn_id in asn_ids:
+            buf += _encode_varint(asn_id)
+        return bytes(buf)
+    else:
+        raise ValueError("Unknown path store encoding {}".format(encoding))
+
+def decode_path(buf, header, asn_table):
+    """
+    Decodes the record at the start of buf (bytes or memoryview) into a list
+    of ASN strings.
+    """
+    if header.encoding == ENCODING_UINT32:
+        count = struct.unpack_from("<I", buf, 0)[0]
+        asn_ids = numpy.frombuffer(buf, dtype="<u4", count=count,
+                                   offset=4).tolist()
+    else:
+        count, pos = _decode_varints(buf, 0, 1)
+        asn_ids = _decode_varints(buf, pos, count[0])[0]
+
+    return [asn_table[asn_id] for asn_id in asn_ids]
+
+def is_path_store(f):
+    """
+    Returns True if the binary file object f is a binary path store.  Leaves
+    the file offset at the start of the file.
+    """
+    f.seek(0)
+    magic = f.read(len(MAGIC))
+    f.seek(0)
+    return magic == MAGIC
+
+def read_header(f):
+    f.seek(0)
+    fields = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+
+    if fields[0] != MAGIC:
+        raise ValueError("Not a binary path store")
+    if fields[1] != VERSION:
+        raise ValueError("Unsupported path store version {}".format(fields[1]))
+
+    return PathStoreHeader(*fields[1:])
+
+def read_asn_table(f, header):
+    if header.num_asns == 0:
+        return []
+    f.seek(header.asn_table_offset)
+    asn_table = f.read().decode("ascii").split("\n")
+    assert(len(asn_table) == header.num_asns)
+    return asn_table
+
+def _count_asns(path_filename):
+    asn_counts = collections.Counter()
+    with open(path_filename, "rb") as path_file:
+        for line in path_file:
+            asn_counts.update(line.split())
+    return asn_counts
+
+def _remap_index(index_filename, out_index_filename, ascii_offsets,
+                 binary_offsets):
+    with open(index_filename, "rb") as index_file:
+        header = index_file.read(24)
+        header_size, num_bins, bytes_per_bin = struct.unpack("<qqq", header)
+        index_file.seek(0)
+        header = index_file.read(header_size)
+
+        with open(out_index_filename, "wb") as out_index_file:
+            out_index_file.write(header)
+
+            bins_left = num_bins
+            while bins_left > 0:
+                num_chunk_bins = min(bins_left, _INDEX_CHUNK_BINS)
+                chunk = numpy.frombuffer(
+                    index_file.read(num_chunk_bins * bytes_per_bin),
+                    dtype=numpy.uint8).reshape(num_chunk_bins, bytes_per_bin)
+
+                full = chunk[:, -1] != 255
+                offsets = numpy.zeros(num_chunk_bins, dtype=numpy.uint64)
+                for byte in range(0, bytes_per_bin):
+                    offsets |= (chunk[:, byte].astype(numpy.uint64) <<
+                                numpy.uint64(8 * byte))
+
+                line_idxs = numpy.searchsorted(ascii_offsets, offsets[full])
+                assert(numpy.all(ascii_offsets[line_idxs] == offsets[full]))
+
+                new_chunk = chunk.copy()
+                new_offsets = binary_offsets[line_idxs]
+                for byte in range(0, bytes_per_bin):
+                    new_chunk[full, byte] = ((new_offsets >>
+                                              numpy.uint64(8 * byte)) &
+                                             numpy.uint64(0xff))
+
+                out_index_file.write(new_chunk.tobytes())
+                bins_left -= num_chunk_bins
+
+def convert_path_file(path_filename, out_path_filename, index_filename=None,
+                      out_index_filename=None, encoding=ENCODING_UINT32):
+    """
+    Writes the ASCII path file path_filename out as a binary path store.  If
+    index_filename is given, its PFI index is rewritten to
+    out_index_filename so that it points into the new file.
+    """
+    asn_counts = _count_asns(path_filename)
+    asn_table = sorted(asn_counts.keys(), key=lambda x: (-asn_counts[x], x))
+    asn_to_id = {asn: asn_id for asn_id, asn in enumerate(asn_table)}
+    logging.info("Interned {} ASNs.".format(len(asn_table)))
+
+    ascii_offsets = array.array("Q")
+    binary_offsets = array.array("Q")
+    max_record_size = 0
+
+    with open(path_filename, "rb") as path_file,\
+         open(out_path_filename, "wb") as out_path_file:
+        out_path_file.write(bytes(HEADER_SIZE))
+
+        ascii_offset = 0
+        binary_offset = HEADER_SIZE
+
+        for line in path_file:
+            asns = line.split()
+            if len(asns) > 0:
+                record = encode_path([asn_to_id[asn] for asn in asns],
+                                     encoding)
+                out_path_file.write(record)
+                ascii_offsets.append(ascii_offset)
+                binary_offsets.append(binary_offset)
+                binary_offset += len(record)
+                max_record_size = max(max_record_size, len(record))
+
+            ascii_offset += len(line)
+
+        asn_table_offset = binary_offset
+        out_path_file.write(b"\n".join(asn_table))
+
+        out_path_file.seek(0)
+        out_path_file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION,
+                                        encoding, len(asn_table),
+                                        asn_table_offset, max_record_size))
+
+    logging.info("Wrote {} paths, {} bytes.".format(len(ascii_offsets),
+                                                     asn_table_offset))
+
+    if index_filename is not None:
+        _remap_index(index_filename, out_index_filename,
+                     numpy.frombuffer(ascii_offsets, dtype=numpy.uint64),
+                     numpy.frombuffer(binary_offsets, dtype=numpy.uint64))
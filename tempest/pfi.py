@@ -1,21 +1,169 @@
 #!/usr/bin/env python3
 
+import collections
 import ctypes
 import io
 import logging
+import mmap
 import os
 import struct
+import sys
+import threading
+import weakref
+
+import numpy
+
+from . import bloom
+from . import path_store
+from . import spookyhash
+
+_NOT_CACHED = object()
+
+LookupTrace = collections.namedtuple("LookupTrace",
+                                     ["bloom_rejected", "num_probes",
+                                      "num_comparisons", "path_bytes_read"])
+
+_PREAD_LINE_SIZE = 512
+
+_path_caches = weakref.WeakSet()
+
+def _reset_path_cache_locks():
+    # A lock held by another thread at fork time would never be released in
+    # the child.
+    for cache in _path_caches:
+        cache._lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_path_cache_locks)
+
+class PathCache(object):
+    """
+    Bounded LRU cache of decoded paths keyed by (src, dst).  Failed lookups
+    (None) are cached too.  Least recently used entries are evicted once the
+    cache holds more than max_entries paths or its estimated size exceeds
+    max_bytes; either bound may be None.  All methods are thread-safe.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        self._lock = threading.Lock()
+        _path_caches.add(self)
+
+    @staticmethod
+    def _entry_size(key, path):
+        size = sys.getsizeof(key) + sum(map(sys.getsizeof, key))
+        if path is not None:
+            size += sys.getsizeof(path) + sum(map(sys.getsizeof, path))
+        return size
+
+    def _evict(self):
+        while (len(self._entries) > 0 and
+               ((self._max_entries is not None and
+                 len(self._entries) > self._max_entries) or
+                (self._max_bytes is not None and
+                 self._num_bytes > self._max_bytes))):
+            key, (path, size) = self._entries.popitem(last=False)
+            self._num_bytes -= size
+            self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def get(self, key, default=None):
+        """
+        Returns a copy of the path cached for key, or default if key is not
+        cached.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self._misses += 1
+                return default
+
+            self._hits += 1
+            self._entries.move_to_end(key)
+            path = self._entries[key][0]
+
+        return None if path is None else list(path)
+
+    def put(self, key, path):
+        if path is not None:
+            path = list(path)
+
+        size = PathCache._entry_size(key, path)
+
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (path, size)
+            self._num_bytes += size
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses,
+                    "evictions": self._evictions,
+                    "entries": len(self._entries), "bytes": self._num_bytes}
 
 class PFI(object):
-    def __init__(self, libspookyhash_path, path_filename, index_filename):
+    def __init__(self, libspookyhash_path, path_filename, index_filename,
+                 use_mmap=False, cache_max_entries=None, cache_max_bytes=None,
+                 bloom_filename=None, use_pread=False):
+        """
+        If libspookyhash_path is None, keys are hashed with the pure Python
+        SpookyHash in tempest.spookyhash instead of the compiled library.
+
+        If use_mmap is True, load() maps the index and path files into memory
+        and lookups are served from memoryview slices instead of seek/read
+        calls on the file handles.  If use_pread is True, lookups read with
+        os.pread instead.  Either way no lookup moves a shared file offset, so
+        one loaded PFI can serve lookups from several threads, and from
+        processes forked after load().  The default file-handle mode cannot.
+
+        path_filename may be either the ASCII path file or a binary path store
+        written by tempest.path_store.convert_path_file(); the format is
+        detected in load().
+
+        If cache_max_entries or cache_max_bytes is set, decoded paths are kept
+        in a PathCache with those bounds; see cache_stats().
+
+        If bloom_filename names a filter written by
+        tempest.bloom.build_bloom_filter(), load() opens it and keys the
+        filter rules out are answered with None without any index I/O.
+        """
         self._libhash_path = libspookyhash_path
         self._path_filename = path_filename
         self._index_filename = index_filename
+        self._use_mmap = use_mmap
+        self._use_pread = use_pread and not use_mmap
+        self._bloom_filename = bloom_filename
 
         self._libhash = None
+        self._bloom_filter = None
         self._path_file = None
         self._index_file = None
 
+        self._index_map = None
+        self._index_view = None
+        self._path_map = None
+        self._path_view = None
+
+        self._path_store_header = None
+        self._asn_table = None
+
+        self._cache = None
+        if cache_max_entries is not None or cache_max_bytes is not None:
+            self._cache = PathCache(cache_max_entries, cache_max_bytes)
+
         self._header_size = 0
         self._num_bins = 0
         self._bytes_per_bin = 0
@@ -34,47 +182,340 @@ class PFI(object):
         self._index_file.seek(-1 * self._bytes_per_bin, io.SEEK_CUR)
         return data[-1] == 255
 
+    def _hash_key(self, key):
+        if self._libhash is None:
+            return spookyhash.hash64(key)
+        return self._libhash.hash_string(key)
+
+    def _hash_keys(self, keys):
+        """
+        Hashes a list of byte string keys, using a single call into the hash
+        library when it exports hash_strings, or a single vectorized call when
+        no library is loaded.
+        """
+        if self._libhash is None:
+            return spookyhash.hash64_array(keys).tolist()
+
+        if not hasattr(self._libhash, "hash_strings"):
+            return [self._libhash.hash_string(key) for key in keys]
+
+        num_keys = len(keys)
+        key_array = (ctypes.c_char_p * num_keys)(*keys)
+        hash_array = (ctypes.c_uint64 * num_keys)()
+        self._libhash.hash_strings(key_array, num_keys, hash_array)
+        return list(hash_array)
+
+    def _load_libhash(self):
+        self._libhash = ctypes.cdll.LoadLibrary(self._libhash_path)
+        self._libhash.hash_string.argtypes = [ctypes.c_char_p]
+        self._libhash.hash_string.restype = ctypes.c_ulonglong
+        if hasattr(self._libhash, "hash_strings"):
+            self._libhash.hash_strings.argtypes =\
+                [ctypes.POINTER(ctypes.c_char_p), ctypes.c_size_t,
+                 ctypes.POINTER(ctypes.c_uint64)]
+            self._libhash.hash_strings.restype = None
+
+    def _lookup_bin(self, bin):
+        """
+        Returns the path file offset stored in bin, or None if bin is blank.
+        """
+        if self._use_mmap:
+            start = self._header_size + (bin * self._bytes_per_bin)
+            data = self._index_view[start:start + self._bytes_per_bin]
+            if data[-1] == 255:
+                return None
+            return int.from_bytes(data, "little")
+        elif self._use_pread:
+            data = os.pread(self._index_file.fileno(), self._bytes_per_bin,
+                            self._header_size + (bin * self._bytes_per_bin))
+            if data[-1] == 255:
+                return None
+            return int.from_bytes(data, "little")
+        else:
+            self._seek_to_bin(bin)
+            if self._bin_is_blank():
+                return None
+            return self._bin_contents()
+
     def _read_header_meta(self):
         self._header_size = struct.unpack("<q", self._index_file.read(8))[0]
         self._num_bins = struct.unpack("<q", self._index_file.read(8))[0]
         self._bytes_per_bin = struct.unpack("<q", self._index_file.read(8))[0]
 
+    def _read_path(self, path_file_offset):
+        return self._read_path_record(path_file_offset)[0]
+
+    def _read_path_record(self, path_file_offset):
+        """
+        Returns (path, bytes read from the path file) for the record at
+        path_file_offset.
+        """
+        if self._path_store_header is not None:
+            return self._read_binary_path(path_file_offset)
+
+        if self._use_mmap:
+            end = self._path_map.find(b"\n", path_file_offset)
+            if end == -1:
+                end = len(self._path_map)
+            line = str(self._path_view[path_file_offset:end], "ascii")
+            return (line.strip().split(" "),
+                    min(end + 1, len(self._path_map)) - path_file_offset)
+        elif self._use_pread:
+            line, num_bytes = self._pread_line(path_file_offset)
+            return line.strip().decode("ascii").split(" "), num_bytes
+        else:
+            self._path_file.seek(path_file_offset, io.SEEK_SET)
+            line = self._path_file.readline()
+            return line.strip().decode("ascii").split(" "), len(line)
+
+    def _pread_line(self, path_file_offset):
+        """
+        Returns (line without its newline, bytes read).
+        """
+        fd = self._path_file.fileno()
+        chunks = []
+        num_bytes = 0
+
+        while True:
+            chunk = os.pread(fd, _PREAD_LINE_SIZE, path_file_offset)
+            num_bytes += len(chunk)
+            end = chunk.find(b"\n")
+            if end != -1:
+                chunks.append(chunk[:end])
+                break
+            chunks.append(chunk)
+            if len(chunk) < _PREAD_LINE_SIZE:
+                break
+            path_file_offset += len(chunk)
+
+        return b"".join(chunks), num_bytes
+
+    def _read_binary_path(self, path_file_offset):
+        """
+        Returns (path, bytes read from the path file).
+        """
+        record_size = self._path_store_header.max_record_size
+        if self._use_mmap:
+            record = self._path_view[path_file_offset:
+                                     path_file_offset + record_size]
+        elif self._use_pread:
+            record = os.pread(self._path_file.fileno(), record_size,
+                              path_file_offset)
+        else:
+            self._path_file.seek(path_file_offset, io.SEEK_SET)
+            record = self._path_file.read(record_size)
+        return (path_store.decode_path(record, self._path_store_header,
+                                       self._asn_table), len(record))
+
     def _seek_to_bin(self, bin):
         offset = self._header_size + (bin * self._bytes_per_bin)
         self._index_file.seek(offset, io.SEEK_SET)
 
+    def is_fork_safe(self):
+        """
+        Returns True if lookups never move a shared file offset (use_mmap or
+        use_pread), so processes forked after load() can use this PFI.
+        """
+        return self._use_mmap or self._use_pread
+
     def close(self):
         try:
+            if self._use_mmap:
+                self._index_view.release()
+                self._path_view.release()
+                self._index_map.close()
+                self._path_map.close()
             self._index_file.close()
             self._path_file.close()
         except:
             pass
 
-    def get_path(self, src, dst):
-        if (src == dst): return [src]
+    def _probe_path(self, src, dst):
         key = src.encode("ascii") + b" " + dst.encode("ascii")
-        hash_value = self._libhash.hash_string(key)
+        hash_value = self._hash_key(key)
+
+        if (self._bloom_filter is not None and
+            not self._bloom_filter.might_contain(hash_value)):
+            return None
+
         i = 0
-        bin = self._bin_index(hash_value, i)
-        self._seek_to_bin(bin)
+        path_file_offset = self._lookup_bin(self._bin_index(hash_value, i))
 
-        while not self._bin_is_blank():
+        while path_file_offset is not None:
             # See if we have the correct result...
-            path_file_offset = self._bin_contents()
-            self._path_file.seek(path_file_offset, io.SEEK_SET)
-            line =\
-                self._path_file.readline().strip().decode("ascii").split(" ")
+            line = self._read_path(path_file_offset)
             if (line[0] == src and line[-1] == dst):
                 return line
             else:
                 i += 1
-                bin = self._bin_index(hash_value, i)
-                self._seek_to_bin(bin)
+                path_file_offset =\
+                    self._lookup_bin(self._bin_index(hash_value, i))
 
         return None
 
+    def cache_stats(self):
+        """
+        Returns a dict of path cache hits, misses, evictions, entries and
+        estimated bytes, or None if caching is disabled.
+        """
+        if self._cache is None:
+            return None
+        return self._cache.stats()
+
+    def clear_cache(self):
+        if self._cache is not None:
+            self._cache.clear()
+
+    def get_path(self, src, dst):
+        if (src == dst): return [src]
+
+        if self._cache is not None:
+            path = self._cache.get((src, dst), _NOT_CACHED)
+            if path is not _NOT_CACHED:
+                return path
+
+        path = self._probe_path(src, dst)
+
+        if self._cache is not None:
+            self._cache.put((src, dst), path)
+
+        return path
+
+    def get_paths(self, pairs):
+        """
+        Looks up the path for every (src, dst) pair in pairs.  Returns a list
+        with one entry (path or None) per pair, in the same order as pairs.
+
+        All keys are hashed up front.  Each probing round then visits index
+        bins, and afterwards path file offsets, in ascending order, so large
+        batches read both files mostly sequentially.
+        """
+        pairs = list(pairs)
+        paths = [None] * len(pairs)
+
+        pending = []
+        keys = []
+        for idx, (src, dst) in enumerate(pairs):
+            if (src == dst):
+                paths[idx] = [src]
+                continue
+
+            if self._cache is not None:
+                path = self._cache.get((src, dst), _NOT_CACHED)
+                if path is not _NOT_CACHED:
+                    paths[idx] = path
+                    continue
+
+            pending.append(idx)
+            keys.append(src.encode("ascii") + b" " + dst.encode("ascii"))
+
+        hash_values = self._hash_keys(keys)
+        if self._bloom_filter is not None and len(hash_values) > 0:
+            maybe_present = self._bloom_filter.might_contain_hashes(
+                hash_values).tolist()
+        else:
+            maybe_present = [True] * len(hash_values)
+
+        probes = [(idx, hash_value, 0) for idx, hash_value, present in
+                  zip(pending, hash_values, maybe_present) if present]
+
+        while len(probes) > 0:
+            bins = sorted((self._bin_index(hash_value, i), idx, hash_value, i)
+                          for idx, hash_value, i in probes)
+
+            candidates = []
+            for bin, idx, hash_value, i in bins:
+                path_file_offset = self._lookup_bin(bin)
+                if path_file_offset is not None:
+                    candidates.append((path_file_offset, idx, hash_value, i))
+
+            candidates.sort()
+
+            probes = []
+            for path_file_offset, idx, hash_value, i in candidates:
+                src, dst = pairs[idx]
+                line = self._read_path(path_file_offset)
+                if (line[0] == src and line[-1] == dst):
+                    paths[idx] = line
+                else:
+                    probes.append((idx, hash_value, i + 1))
+
+        if self._cache is not None:
+            for idx in pending:
+                self._cache.put(pairs[idx], paths[idx])
+
+        return paths
+
+    def load_factor(self, chunk_bins=1 << 22):
+        """
+        Returns the fraction of index bins that are not blank.
+        """
+        fd = self._index_file.fileno()
+        num_full = 0
+
+        for first_bin in range(0, self._num_bins, chunk_bins):
+            num_chunk_bins = min(chunk_bins, self._num_bins - first_bin)
+            data = os.pread(fd, num_chunk_bins * self._bytes_per_bin,
+                            self._header_size +
+                            (first_bin * self._bytes_per_bin))
+            last_bytes = numpy.frombuffer(data, dtype=numpy.uint8)[
+                self._bytes_per_bin - 1::self._bytes_per_bin]
+            num_full += int(numpy.count_nonzero(last_bytes != 255))
+
+        return float(num_full) / float(self._num_bins)
+
+    def sample_paths(self, num_samples, rng):
+        """
+        Returns num_samples paths read from uniformly random non-blank bins,
+        i.e. a uniform sample of indexed paths.  rng is a random.Random.
+        """
+        paths = []
+        while len(paths) < num_samples:
+            path_file_offset = self._lookup_bin(rng.randrange(self._num_bins))
+            if path_file_offset is not None:
+                paths.append(self._read_path(path_file_offset))
+        return paths
+
+    def trace_path(self, src, dst):
+        """
+        Looks up (src, dst) like get_path(), bypassing the path cache, and
+        returns (path, LookupTrace).  num_probes counts index bins read,
+        including the blank bin that ends a miss; num_comparisons counts path
+        records read and compared against (src, dst); path_bytes_read counts
+        the path file bytes those reads fetched in the current lookup mode
+        (whole 512-byte chunks with use_pread, max_record_size per record in
+        a binary path store).
+        """
+        if (src == dst): return [src], LookupTrace(False, 0, 0, 0)
+
+        key = src.encode("ascii") + b" " + dst.encode("ascii")
+        hash_value = self._hash_key(key)
+
+        if (self._bloom_filter is not None and
+            not self._bloom_filter.might_contain(hash_value)):
+            return None, LookupTrace(True, 0, 0, 0)
+
+        num_comparisons = 0
+        path_bytes_read = 0
+
+        i = 0
+        path_file_offset = self._lookup_bin(self._bin_index(hash_value, i))
+
+        while path_file_offset is not None:
+            line, num_bytes = self._read_path_record(path_file_offset)
+            num_comparisons += 1
+            path_bytes_read += num_bytes
+            if (line[0] == src and line[-1] == dst):
+                return line, LookupTrace(False, i + 1, num_comparisons,
+                                         path_bytes_read)
+            i += 1
+            path_file_offset = self._lookup_bin(self._bin_index(hash_value, i))
+
+        return None, LookupTrace(False, i + 1, num_comparisons,
+                                 path_bytes_read)
+
     def verify(self):
-        assert(self._libhash.hash_string(b"qwerty12345") ==
+        assert(self._hash_key(b"qwerty12345") ==
                9134894412101018003)
 
         real_index_file_sz = os.path.getsize(self._index_filename)
@@ -86,9 +527,23 @@ class PFI(object):
         return True
 
     def load(self):
-        self._libhash = ctypes.cdll.LoadLibrary(self._libhash_path)
-        self._libhash.hash_string.argtypes = [ctypes.c_char_p]
-        self._libhash.hash_string.restype = ctypes.c_ulonglong
+        if self._libhash_path is not None:
+            self._load_libhash()
         self._index_file = open(self._index_filename, "rb", buffering=-1)
         self._read_header_meta()
+        if self._bloom_filename is not None:
+            self._bloom_filter = bloom.BloomFilter.load(self._bloom_filename)
         self._path_file = open(self._path_filename, "rb", buffering=-1)
+
+        if path_store.is_path_store(self._path_file):
+            self._path_store_header = path_store.read_header(self._path_file)
+            self._asn_table = path_store.read_asn_table(self._path_file,
+                                                        self._path_store_header)
+
+        if self._use_mmap:
+            self._index_map = mmap.mmap(self._index_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            self._index_view = memoryview(self._index_map)
+            self._path_map = mmap.mmap(self._path_file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            self._path_view = memoryview(self._path_map)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Builds PFI index files in the same on-disk format as pfi/index.cc: a Meta
+header (header_size, num_bins, bytes_per_bin) followed by num_bins
+little-endian bins of bytes_per_bin bytes, blank bins filled with 0xFF, and
+keys placed by quadratic probing on (hash + i*i) % num_bins.
+
+Keys are hashed in vectorized chunks, optionally across a process pool, and
+each chunk is inserted into the bin table with whole-array probing rounds.
+The table is either held in memory or filled in place through an mmap of the
+output file.  Paths may be placed in different (equally valid) bins than
+index.cc would pick when their probe sequences collide.
+"""
+
+import itertools
+import logging
+import math
+import multiprocessing
+import struct
+
+import numpy
+
+from . import spookyhash
+
+HEADER_FORMAT = "<QQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+_MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+def _is_prime(n):
+    if n < 2:
+        return False
+
+    for p in _MILLER_RABIN_BASES:
+        if n % p == 0:
+            return n == p
+
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    # These bases make the test deterministic for all n < 3.3 * 10^24.
+    for a in _MILLER_RABIN_BASES:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(0, s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+def next_prime(n):
+    """
+    Returns the smallest prime greater than n, as GMP's mpz_nextprime does.
+    """
+    candidate = n + 1
+    while not _is_prime(candidate):
+        candidate += 1
+    return candidate
+
+def num_bins(num_lines):
+    return next_prime(2 * num_lines)
+
+def bytes_per_bin(num_bytes):
+    return int(math.ceil((math.log2(num_bytes) + 1) / 8))
+
+def path_file_stats(path_filename, block_size=1 << 24):
+    """
+    Returns (number of lines, number of bytes) in the path file.
+    """
+    num_lines = 0
+    num_bytes = 0
+    last_byte = b"\n"
+
+    with open(path_filename, "rb") as path_file:
+        while True:
+            block = path_file.read(block_size)
+            if len(block) == 0:
+                break
+            num_lines += block.count(b"\n")
+            num_bytes += len(block)
+            last_byte = block[-1:]
+
+    if last_byte != b"\n":
+        num_lines += 1
+
+    return num_lines, num_bytes
+
+def read_key_chunks(path_filename, chunk_lines):
+    """
+    Yields (keys, offsets) chunks of up to chunk_lines paths, where each key
+    is the "src dst" string PFI hashes and each offset is the path's byte
+    offset in the path file.  Lines without a space are skipped.
+    """
+    keys = []
+    offsets = []
+
+    with open(path_filename, "rb") as path_file:
+        offset = 0
+        for line in path_file:
+            stripped = line.rstrip(b"\n")
+            first_space = stripped.find(b" ")
+
+            if first_space == -1:
+                logging.warning("Skipping line {}".format(stripped))
+            else:
+                keys.append(stripped[:first_space] +
+                            stripped[stripped.rfind(b" "):])
+                offsets.append(offset)
+
+            offset += len(line)
+
+            if len(keys) == chunk_lines:
+                yield keys, numpy.array(offsets, dtype=numpy.uint64)
+                keys = []
+                offsets = []
+
+    if len(keys) > 0:
+        yield keys, numpy.array(offsets, dtype=numpy.uint64)
+
+def _hash_key_chunk(chunk):
+    keys, offsets = chunk
+    return spookyhash.hash64_array(keys), offsets
+
+def insert_chunk(bins, hashes, offsets):
+    """
+    Inserts every (hash, offset) pair into the (num_bins, bytes_per_bin)
+    uint8 bin table.  Each round probes the next quadratic bin for every
+    pending key; where several keys reach the same blank bin in one round,
+    the first of them takes it.
+    """
+    num_bins, bytes_per_bin = bins.shape
+    base_bins = hashes % numpy.uint64(num_bins)
+    pending = numpy.arange(len(hashes))
+    i = 0
+
+    while len(pending) > 0:
+        probe = (base_bins[pending] +
+                 numpy.uint64((i * i) % num_bins)) % numpy.uint64(num_bins)
+        probe = probe.astype(numpy.int64)
+
+        blank = numpy.flatnonzero(bins[probe, -1] == 255)
+        won = blank[numpy.unique(probe[blank], return_index=True)[1]]
+
+        won_bins = probe[won]
+        won_offsets = offsets[pending[won]]
+        for byte in range(0, bytes_per_bin):
+            bins[won_bins, byte] = ((won_offsets >> numpy.uint64(8 * byte)) &
+                                    numpy.uint64(0xff))
+
+        lost = numpy.ones(len(pending), dtype=bool)
+        lost[won] = False
+        pending = pending[lost]
+        i += 1
+
+def build_index(path_filename, index_filename, num_procs=1,
+                chunk_lines=1 << 20, use_mmap=False):
+    """
+    Writes a PFI index for path_filename to index_filename.
+
+    Keyword Arguments:
+        num_procs -- Number of processes to hash key chunks with
+
+        chunk_lines -- Number of paths hashed and inserted per chunk
+
+        use_mmap -- Fill the bin table in place through an mmap of
+        index_filename instead of in memory
+    """
+    num_lines, num_bytes = path_file_stats(path_filename)
+    header = (HEADER_SIZE, num_bins(num_lines), bytes_per_bin(num_bytes))
+
+    logging.info("Path file lines:\t{}".format(num_lines))
+    logging.info("Path file bytes:\t{}".format(num_bytes))
+    logging.info("Num bins:\t{}".format(header[1]))
+    logging.info("Bytes per bin:\t{}".format(header[2]))
+
+    with open(index_filename, "wb") as index_file:
+        index_file.write(struct.pack(HEADER_FORMAT, *header))
+        if use_mmap:
+            index_file.truncate(HEADER_SIZE + header[1] * header[2])
+
+    if use_mmap:
+        bins = numpy.memmap(index_filename, dtype=numpy.uint8, mode="r+",
+                            offset=HEADER_SIZE, shape=(header[1], header[2]))
+        bins[:] = 255
+    else:
+        bins = numpy.full((header[1], header[2]), 255, dtype=numpy.uint8)
+
+    chunks = read_key_chunks(path_filename, chunk_lines)
+    pool = None
+    if num_procs > 1:
+        pool = multiprocessing.Pool(num_procs)
+
+    num_indexed = 0
+    while True:
+        # Hash at most num_procs chunks at once to keep memory bounded.
+        batch = list(itertools.islice(chunks, max(num_procs, 1)))
+        if len(batch) == 0:
+            break
+
+        if pool is None:
+            hashed = map(_hash_key_chunk, batch)
+        else:
+            hashed = pool.map(_hash_key_chunk, batch)
+
+        for hashes, offsets in hashed:
+            insert_chunk(bins, hashes, offsets)
+            num_indexed += len(offsets)
+
+        logging.info("Indexed {} lines.".format(num_indexed))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if use_mmap:
+        bins.flush()
+        del bins
+    else:
+        with open(index_filename, "ab") as index_file:
+            bins.tofile(index_file)
+
+    logging.info("Indexed {} lines in total.".format(num_indexed))
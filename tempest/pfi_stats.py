@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Index health report for a loaded PFI.  Samples lookups, traces each one with
+PFI.trace_path(), and summarizes probe-chain lengths, string comparisons and
+path file bytes read, next to what uniform hashing would give at the index's
+load factor.  Probe counts well above the uniform expectation point at
+clustering in the (hash + i*i) % num_bins scheme; normal probe counts with
+slow lookups point at I/O.
+"""
+
+import collections
+import math
+import time
+
+def expected_probes(load_factor):
+    """
+    Returns (probes per hit, probes per miss) expected under uniform hashing
+    at the given load factor.
+    """
+    if load_factor <= 0.:
+        return 1., 1.
+    if load_factor >= 1.:
+        return math.inf, math.inf
+    hit = (1. / load_factor) * math.log(1. / (1. - load_factor))
+    miss = 1. / (1. - load_factor)
+    return hit, miss
+
+def sample_pairs(pfi, num_samples, rng):
+    """
+    Returns num_samples (src, dst) pairs known to be indexed, followed by
+    num_samples pairs made by re-pairing their sources with shuffled
+    destinations (skipping src == dst), most of which are misses on sparse
+    topologies.
+    """
+    paths = pfi.sample_paths(num_samples, rng)
+    hit_pairs = [(path[0], path[-1]) for path in paths]
+    dsts = [dst for _, dst in hit_pairs]
+    rng.shuffle(dsts)
+    shuffled_pairs = [(src, dst) for (src, _), dst in zip(hit_pairs, dsts) if
+                      src != dst]
+    return hit_pairs + shuffled_pairs
+
+def _summarize(traces, seconds):
+    num_lookups = len(traces)
+    if num_lookups == 0:
+        return {"lookups": 0}
+
+    probed = [t for t in traces if not t.bloom_rejected]
+    num_probed = max(len(probed), 1)
+
+    return {
+        "lookups": num_lookups,
+        "bloom_rejected": num_lookups - len(probed),
+        "probe_histogram":
+            dict(sorted(collections.Counter(t.num_probes for t in
+                                            probed).items())),
+        "mean_probes": sum(t.num_probes for t in probed) / num_probed,
+        "max_probes": max([t.num_probes for t in probed] + [0]),
+        "mean_comparisons":
+            sum(t.num_comparisons for t in probed) / num_probed,
+        "mean_path_bytes_read":
+            sum(t.path_bytes_read for t in traces) / num_lookups,
+        "mean_seconds": sum(seconds) / num_lookups,
+    }
+
+def health_report(pfi, pairs):
+    """
+    Traces a lookup of every (src, dst) pair and returns a dict with the
+    index's load factor, the uniform hashing expectation, and separate
+    summaries for hits and misses.
+    """
+    hit_traces, hit_seconds = [], []
+    miss_traces, miss_seconds = [], []
+
+    for src, dst in pairs:
+        start = time.perf_counter()
+        path, trace = pfi.trace_path(src, dst)
+        elapsed = time.perf_counter() - start
+
+        if path is None:
+            miss_traces.append(trace)
+            miss_seconds.append(elapsed)
+        else:
+            hit_traces.append(trace)
+            hit_seconds.append(elapsed)
+
+    load_factor = pfi.load_factor()
+    expected_hit, expected_miss = expected_probes(load_factor)
+
+    return {
+        "load_factor": load_factor,
+        "expected_probes_per_hit": expected_hit,
+        "expected_probes_per_miss": expected_miss,
+        "hits": _summarize(hit_traces, hit_seconds),
+        "misses": _summarize(miss_traces, miss_seconds),
+    }
+
+def format_report(report):
+    lines = ["load factor:\t{:.4f}".format(report["load_factor"]),
+             "uniform hashing probes per hit:\t{:.3f}".format(
+                 report["expected_probes_per_hit"]),
+             "uniform hashing probes per miss:\t{:.3f}".format(
+                 report["expected_probes_per_miss"])]
+
+    for name in ("hits", "misses"):
+        summary = report[name]
+        lines.append("* {} *".format(name.upper()))
+        for key, value in summary.items():
+            lines.append("{}:\t{}".format(key, value))
+
+    return "\n".join(lines)
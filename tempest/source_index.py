@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Source-clustered path index.  Where a PFI answers exact (src, dst) lookups,
+a SourceIndex streams every path that starts at one source AS.
+
+build_source_index() rewrites an ASCII path file so that all paths from the
+same source are contiguous, and writes an index with one line per source:
+    <src ASN> <block start offset> <block end offset>
+The rewritten file is still a valid path file, but its offsets differ from
+the input's, so a PFI over it needs its own index.
+"""
+
+import logging
+import os
+import tempfile
+
+# Upper bound on the number of bucket files build_source_index() keeps open.
+_MAX_BUCKETS = 256
+_BUCKET_BUFFER_SIZE = 1 << 16
+
+def build_source_index(path_filename, out_path_filename, out_index_filename,
+                       bucket_size=1 << 28, tmp_dir=None):
+    """
+    Writes a source-sorted copy of path_filename to out_path_filename and the
+    matching source index to out_index_filename.
+
+    The sort is external: a first pass totals the bytes of each source's
+    paths, consecutive ranges of sources are assigned to buckets of about
+    bucket_size bytes (at most _MAX_BUCKETS, raising bucket_size for larger
+    inputs), a second pass appends each line to its bucket's file
+    in tmp_dir (default: out_path_filename's directory), and each bucket is
+    then sorted in memory and appended to the output.  A bucket holds less
+    than bucket_size bytes plus its last source's paths, so memory is bounded
+    by that plus a byte count per source, and all file I/O is sequential.
+    Paths from one source keep their input order.
+    """
+    src_sizes = dict()
+    with open(path_filename, "rb") as path_file:
+        for line in path_file:
+            src = _line_source(line)
+            if len(src) > 0:
+                src_sizes[src] = src_sizes.get(src, 0) + len(line) + 1
+
+    srcs = sorted(src_sizes.keys())
+    total_size = sum(src_sizes.values())
+    bucket_size = max(bucket_size, -(-total_size // _MAX_BUCKETS), 1)
+
+    # A source goes to the bucket its first byte falls in, so there are at
+    # most ceil(total_size / bucket_size) <= _MAX_BUCKETS buckets.
+    src_to_bucket = dict()
+    num_buckets = 0
+    last_slot = None
+    src_start = 0
+    for src in srcs:
+        slot = src_start // bucket_size
+        if slot != last_slot:
+            num_buckets += 1
+            last_slot = slot
+        src_to_bucket[src] = num_buckets - 1
+        src_start += src_sizes[src]
+    del src_sizes
+
+    logging.info("Sorting paths from {} sources in {} buckets.".format(
+        len(srcs), num_buckets))
+
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(out_path_filename))
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as bucket_dir:
+        bucket_filenames = [os.path.join(bucket_dir, str(bucket)) for bucket
+                            in range(num_buckets)]
+
+        bucket_files = [open(filename, "wb", buffering=_BUCKET_BUFFER_SIZE)
+                        for filename in bucket_filenames]
+        try:
+            with open(path_filename, "rb") as path_file:
+                for line in path_file:
+                    src = _line_source(line)
+                    if len(src) > 0:
+                        if not line.endswith(b"\n"):
+                            line += b"\n"
+                        bucket_files[src_to_bucket[src]].write(line)
+        finally:
+            for bucket_file in bucket_files:
+                bucket_file.close()
+        del src_to_bucket
+
+        with open(out_path_filename, "wb") as out_path_file,\
+             open(out_index_filename, "w") as out_index_file:
+            out_offset = 0
+            for bucket_filename in bucket_filenames:
+                with open(bucket_filename, "rb") as bucket_file:
+                    lines = bucket_file.read().split(b"\n")
+                os.remove(bucket_filename)
+                lines.pop()
+                lines.sort(key=_line_source)
+
+                block_src = None
+                for line in lines:
+                    src = _line_source(line)
+                    if src != block_src:
+                        if block_src is not None:
+                            _write_block(out_index_file, block_src,
+                                         block_start, out_offset)
+                        block_src = src
+                        block_start = out_offset
+                    out_path_file.write(line)
+                    out_path_file.write(b"\n")
+                    out_offset += len(line) + 1
+
+                if block_src is not None:
+                    _write_block(out_index_file, block_src, block_start,
+                                 out_offset)
+
+def _line_source(line):
+    return line.split(b" ", 1)[0].strip()
+
+def _write_block(index_file, src, start, end):
+    index_file.write("{} {} {}\n".format(src.decode("ascii"), start, end))
+
+class SourceIndex(object):
+    def __init__(self, path_filename, index_filename, read_size=1 << 20):
+        self._path_filename = path_filename
+        self._index_filename = index_filename
+        self._read_size = read_size
+
+        self._path_file = None
+        self._blocks = None
+
+    def close(self):
+        try:
+            self._path_file.close()
+        except:
+            pass
+
+    def load(self):
+        self._blocks = dict()
+        with open(self._index_filename, "r") as index_file:
+            for line in index_file:
+                src, start, end = line.split()
+                self._blocks[src] = (int(start), int(end))
+        self._path_file = open(self._path_filename, "rb")
+
+    def block_size(self, src):
+        """
+        Returns the size in bytes of src's block of paths.
+        """
+        if src not in self._blocks:
+            return 0
+        start, end = self._blocks[src]
+        return end - start
+
+    def paths_from(self, src):
+        """
+        Yields every path starting at src, as a list of ASNs, by reading src's
+        block of the path file sequentially.  Reads do not move a shared file
+        offset, so several iterators may be consumed at once.
+        """
+        if src not in self._blocks:
+            return
+
+        offset, end = self._blocks[src]
+        fd = self._path_file.fileno()
+        leftover = b""
+
+        while offset < end:
+            chunk = os.pread(fd, min(self._read_size, end - offset), offset)
+            if len(chunk) == 0:
+                break
+            offset += len(chunk)
+            lines = (leftover + chunk).split(b"\n")
+            leftover = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if len(line) > 0:
+                    yield line.decode("ascii").split(" ")
+
+        leftover = leftover.strip()
+        if len(leftover) > 0:
+            yield leftover.decode("ascii").split(" ")
+
+    def sources(self):
+        return sorted(self._blocks.keys())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Pure Python port of Bob Jenkins' SpookyHash V2 (pfi/spooky.cc), bit-exact with
+the hash_string() function exported by libspookyhash.  hash64() hashes a
+single message; hash64_array() hashes many short messages at once with NumPy.
+"""
+
+import numpy
+
+SC_CONST = 0xdeadbeefdeadbeef
+SC_NUM_VARS = 12
+SC_BLOCK_SIZE = SC_NUM_VARS * 8
+SC_BUF_SIZE = 2 * SC_BLOCK_SIZE
+
+_MASK64 = 0xffffffffffffffff
+
+_MIX_ROTATIONS = (11, 32, 43, 31, 17, 28, 39, 57, 55, 54, 22, 46)
+_END_PARTIAL_ROTATIONS = (44, 15, 34, 21, 38, 33, 10, 13, 38, 53, 42, 54)
+_SHORT_MIX_ROTATIONS = (50, 52, 30, 41, 54, 48, 38, 37, 62, 34, 5, 36)
+_SHORT_END_ROTATIONS = (15, 52, 26, 51, 28, 9, 47, 54, 32, 25, 63)
+
+def _rot64(x, k):
+    return ((x << k) & _MASK64) | (x >> (64 - k))
+
+def _mix(data, s):
+    for i in range(0, SC_NUM_VARS):
+        s[i] = (s[i] + data[i]) & _MASK64
+        s[(i + 2) % 12] ^= s[(i + 10) % 12]
+        s[(i + 11) % 12] ^= s[i]
+        s[i] = _rot64(s[i], _MIX_ROTATIONS[i])
+        s[(i + 11) % 12] = (s[(i + 11) % 12] + s[(i + 1) % 12]) & _MASK64
+
+def _end_partial(h):
+    for i in range(0, SC_NUM_VARS):
+        h[(i + 11) % 12] = (h[(i + 11) % 12] + h[(i + 1) % 12]) & _MASK64
+        h[(i + 2) % 12] ^= h[(i + 11) % 12]
+        h[(i + 1) % 12] = _rot64(h[(i + 1) % 12], _END_PARTIAL_ROTATIONS[i])
+
+def _end(data, h):
+    for i in range(0, SC_NUM_VARS):
+        h[i] = (h[i] + data[i]) & _MASK64
+    _end_partial(h)
+    _end_partial(h)
+    _end_partial(h)
+
+def _short_mix(h):
+    for i in range(0, 12):
+        x, y, z = (i + 2) % 4, (i + 3) % 4, i % 4
+        h[x] = _rot64(h[x], _SHORT_MIX_ROTATIONS[i])
+        h[x] = (h[x] + h[y]) & _MASK64
+        h[z] ^= h[x]
+
+def _short_end(h):
+    for i in range(0, 11):
+        x, y, z = (i + 3) % 4, (i + 2) % 4, i % 4
+        h[x] ^= h[y]
+        h[y] = _rot64(h[y], _SHORT_END_ROTATIONS[i])
+        h[x] = (h[x] + h[y]) & _MASK64
+
+def _words(data):
+    return [int.from_bytes(data[i:i + 8], "little") for i in
+            range(0, len(data), 8)]
+
+def _short(message, seed1, seed2):
+    length = len(message)
+    h = [seed1, seed2, SC_CONST, SC_CONST]
+    pos = 0
+    remainder = length % 32
+
+    if (length > 15):
+        for pos in range(0, (length // 32) * 32, 32):
+            w = _words(message[pos:pos + 32])
+            h[2] = (h[2] + w[0]) & _MASK64
+            h[3] = (h[3] + w[1]) & _MASK64
+            _short_mix(h)
+            h[0] = (h[0] + w[2]) & _MASK64
+            h[1] = (h[1] + w[3]) & _MASK64
+        pos = (length // 32) * 32
+
+        if (remainder >= 16):
+            w = _words(message[pos:pos + 16])
+            h[2] = (h[2] + w[0]) & _MASK64
+            h[3] = (h[3] + w[1]) & _MASK64
+            _short_mix(h)
+            pos += 16
+            remainder -= 16
+
+    h[3] = (h[3] + (length << 56)) & _MASK64
+
+    if (remainder == 0):
+        h[2] = (h[2] + SC_CONST) & _MASK64
+        h[3] = (h[3] + SC_CONST) & _MASK64
+    else:
+        # The fall-through switch in Short() adds the zero-padded tail as two
+        # little-endian words.
+        w = _words(message[pos:pos + remainder].ljust(16, b"\0"))
+        h[2] = (h[2] + w[0]) & _MASK64
+        h[3] = (h[3] + w[1]) & _MASK64
+
+    _short_end(h)
+    return h[0], h[1]
+
+def hash128(message, seed1=0, seed2=0):
+    """
+    Returns the (hash1, hash2) pair SpookyHash::Hash128 computes for the bytes
+    in message.
+    """
+    message = bytes(message)
+    length = len(message)
+
+    if (length < SC_BUF_SIZE):
+        return _short(message, seed1, seed2)
+
+    h = [seed1, seed2, SC_CONST] * 4
+    end = (length // SC_BLOCK_SIZE) * SC_BLOCK_SIZE
+
+    for pos in range(0, end, SC_BLOCK_SIZE):
+        _mix(_words(message[pos:pos + SC_BLOCK_SIZE]), h)
+
+    remainder = length - end
+    buf = bytearray(message[end:]) + bytearray(SC_BLOCK_SIZE - remainder)
+    buf[SC_BLOCK_SIZE - 1] = remainder
+
+    _end(_words(buf), h)
+    return h[0], h[1]
+
+def hash64(message, seed=0):
+    """
+    Returns the 64-bit SpookyHash of message, i.e. SpookyHash::Hash64.
+    """
+    return hash128(message, seed, seed)[0]
+
+def _np_rot64(x, k):
+    return (x << numpy.uint64(k)) | (x >> numpy.uint64(64 - k))
+
+def _np_short_mix(h):
+    for i in range(0, 12):
+        x, y, z = (i + 2) % 4, (i + 3) % 4, i % 4
+        h[x] = _np_rot64(h[x], _SHORT_MIX_ROTATIONS[i])
+        h[x] += h[y]
+        h[z] ^= h[x]
+
+def _np_short_end(h):
+    for i in range(0, 11):
+        x, y, z = (i + 3) % 4, (i + 2) % 4, i % 4
+        h[x] ^= h[y]
+        h[y] = _np_rot64(h[y], _SHORT_END_ROTATIONS[i])
+        h[x] += h[y]
+
+def hash64_array(messages, seed=0):
+    """
+    Vectorized hash64() over a sequence of byte strings.  Returns a numpy
+    uint64 array with one hash per message.
+
+    Messages shorter than SC_BUF_SIZE bytes (every PFI key) are hashed
+    together with whole-array operations; longer messages fall back to
+    hash64().
+    """
+    messages = [bytes(m) for m in messages]
+    num_messages = len(messages)
+    hashes = numpy.zeros(num_messages, dtype=numpy.uint64)
+
+    if num_messages == 0:
+        return hashes
+
+    lengths = numpy.fromiter(map(len, messages), dtype=numpy.int64,
+                             count=num_messages)
+
+    long_idxs = numpy.flatnonzero(lengths >= SC_BUF_SIZE)
+    for idx in long_idxs:
+        hashes[idx] = hash64(messages[idx], seed)
+
+    short_idxs = numpy.flatnonzero(lengths < SC_BUF_SIZE)
+    if len(short_idxs) == 0:
+        return hashes
+
+    if len(long_idxs) > 0:
+        messages = [messages[idx] for idx in short_idxs]
+        lengths = lengths[short_idxs]
+
+    # Lay the messages out as zero-padded rows of little-endian words, with
+    # enough padding that every row has a whole 16 byte tail to read.
+    num_rows = len(messages)
+    row_bytes = ((int(lengths.max()) // 32) + 1) * 32
+    starts = numpy.cumsum(lengths) - lengths
+    flat = numpy.frombuffer(b"".join(messages), dtype=numpy.uint8)
+    rows = numpy.repeat(numpy.arange(num_rows), lengths)
+    cols = numpy.arange(len(flat)) - numpy.repeat(starts, lengths)
+    buf = numpy.zeros((num_rows, row_bytes), dtype=numpy.uint8)
+    buf[rows, cols] = flat
+    words = buf.view("<u8").astype(numpy.uint64)
+
+    row_idxs = numpy.arange(num_rows)
+    sc_const = numpy.uint64(SC_CONST)
+    h = [numpy.full(num_rows, seed, dtype=numpy.uint64),
+         numpy.full(num_rows, seed, dtype=numpy.uint64),
+         numpy.full(num_rows, SC_CONST, dtype=numpy.uint64),
+         numpy.full(num_rows, SC_CONST, dtype=numpy.uint64)]
+
+    num_blocks = numpy.where(lengths > 15, lengths // 32, 0)
+    for block in range(0, int(num_blocks.max())):
+        sel = num_blocks > block
+        g = [x[sel] for x in h]
+        g[2] += words[sel, 4 * block]
+        g[3] += words[sel, 4 * block + 1]
+        _np_short_mix(g)
+        g[0] += words[sel, 4 * block + 2]
+        g[1] += words[sel, 4 * block + 3]
+        for x, y in zip(h, g):
+            x[sel] = y
+
+    word_pos = num_blocks * 4
+    remainder = lengths % 32
+
+    sel = (lengths > 15) & (remainder >= 16)
+    if numpy.any(sel):
+        g = [x[sel] for x in h]
+        g[2] += words[sel, word_pos[sel]]
+        g[3] += words[sel, word_pos[sel] + 1]
+        _np_short_mix(g)
+        for x, y in zip(h, g):
+            x[sel] = y
+        word_pos[sel] += 2
+        remainder[sel] -= 16
+
+    h[3] += lengths.astype(numpy.uint64) << numpy.uint64(56)
+
+    blank_tail = remainder == 0
+    h[2] += numpy.where(blank_tail, sc_const, words[row_idxs, word_pos])
+    h[3] += numpy.where(blank_tail, sc_const, words[row_idxs, word_pos + 1])
+
+    _np_short_end(h)
+    hashes[short_idxs] = h[0]
+    return hashes
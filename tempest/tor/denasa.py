@@ -2,8 +2,13 @@
 
 from collections import defaultdict
 import functools
+import logging
+import multiprocessing
+import re
 import sys
 
+import numpy
+
 from .. import ip_to_asn
 from . import relays
 
@@ -11,6 +16,10 @@ from . import relays
 # and egress sides of a circuit.
 SUSPECTS = set(["3356", "1299"])
 
+# (guard_fps, guard_fp_to_asns, weight_vector, pfi, sparse) shared with forked
+# workers by compute_guard_selection_prob_matrix().
+_worker_state = None
+
 def bidirectional_lookup(asn_1, asn_2, pfi):
     """
     Returns all the ASes on the forward and reverse paths between the two
@@ -36,42 +45,204 @@ def compute_denasa_guard_selection_probs(client_asns,
     distribution.
     """
 
-    network_state_vars = relays.fat_network_state(network_state_filename)
+    guard_fps, guard_fp_to_asns, guard_weights =\
+        load_guards(network_state_filename, pfx_tree)
 
-    guard_fp_to_ip = relays.get_guards(network_state_vars[0],
-                                       network_state_vars[1])
+    usability_table = make_client_guard_usability_table(client_asns, guard_fps,
+                                                        guard_fp_to_asns, pfi)
 
-    guard_fp_to_asns =\
-            relays.make_relay_fp_to_asns_dict(guard_fp_to_ip, pfx_tree)
+    client_guard_selection_probs = dict()
+    for idx, client_asn in enumerate(client_asns):
+        probs = get_guard_selection_probs_for_client(guard_fps,
+                                                     usability_table[idx],
+                                                     guard_weights)
+        client_guard_selection_probs[client_asn] = probs
+
+    return client_guard_selection_probs
+
+def compute_denasa_guard_selection_prob_matrix(client_asns,
+                                               network_state_filename,
+                                               pfx_tree,
+                                               pfi,
+                                               num_procs=1,
+                                               shard_size=None):
+    """
+    Returns (guard_fps, prob_matrix), where guard_fps is sorted and
+    prob_matrix holds each client's DeNASA guard selection distribution in a
+    row, in client_asns order.  See compute_guard_selection_prob_matrix() for
+    num_procs and shard_size.
+    """
+    guard_fps, guard_fp_to_asns, guard_weights =\
+        load_guards(network_state_filename, pfx_tree)
+    guard_fps = sorted(guard_fps)
+
+    prob_matrix = compute_guard_selection_prob_matrix(client_asns, guard_fps,
+                                                      guard_fp_to_asns,
+                                                      guard_weights, pfi,
+                                                      num_procs, shard_size)
+
+    return guard_fps, prob_matrix
+
+def compute_guard_selection_prob_matrix(client_asns, guard_fps,
+                                        guard_fp_to_asns, guard_weights, pfi,
+                                        num_procs=1, shard_size=None,
+                                        sparse=False):
+    """
+    Returns a client x guard matrix of DeNASA guard selection probabilities,
+    with rows in client_asns order and columns in guard_fps order.  If sparse
+    is True the matrix is a scipy.sparse CSR matrix.
+
+    client_asns is split into shards of shard_size clients that are computed
+    by a pool of num_procs forked workers.  Workers inherit the loaded pfi
+    rather than reopening its files, so with num_procs > 1 it must have been
+    created with use_mmap or use_pread; otherwise ValueError is raised.
+    """
+    global _worker_state
+
+    if num_procs > 1 and not pfi.is_fork_safe():
+        raise ValueError("num_procs > 1 requires a PFI created with use_mmap "
+                         "or use_pread")
+
+    if shard_size is None:
+        shard_size = max(1, -(-len(client_asns) // (4 * max(num_procs, 1))))
+
+    shards = [client_asns[idx:idx + shard_size] for idx in
+              range(0, len(client_asns), shard_size)]
+
+    _worker_state = (guard_fps, guard_fp_to_asns,
+                     guard_weight_vector(guard_fps, guard_weights), pfi,
+                     sparse)
 
-    guard_fps = []
-    for guard_fp, asns in guard_fp_to_asns.items():
-        if asns is not None:
-            guard_fps.append(guard_fp)
+    try:
+        if num_procs > 1:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(num_procs) as pool:
+                shard_matrices = pool.map(_guard_selection_prob_rows, shards)
+        else:
+            shard_matrices = list(map(_guard_selection_prob_rows, shards))
+    finally:
+        _worker_state = None
 
-    guard_weights = relays.pathsim_get_position_weights(guard_fps,
-                                                        network_state_vars[0],
-                                                        'g',
-                                                        network_state_vars[4],
-                                                        network_state_vars[5])
+    if len(shard_matrices) == 0:
+        shard_matrices = [guard_selection_prob_matrix(
+            numpy.zeros((0, len(guard_fps)), dtype=bool),
+            guard_weight_vector(guard_fps, guard_weights), sparse)]
+
+    if sparse:
+        import scipy.sparse
+        return scipy.sparse.vstack(shard_matrices, format="csr")
+
+    return numpy.vstack(shard_matrices)
+
+def _guard_selection_prob_rows(client_asns):
+    guard_fps, guard_fp_to_asns, weight_vector, pfi, sparse = _worker_state
 
     usability_table = make_client_guard_usability_table(client_asns, guard_fps,
                                                         guard_fp_to_asns, pfi)
 
-    client_guard_selection_probs = dict()
-    for client_asn in client_asns:
-        probs = get_guard_selection_probs_for_client(guard_fps, client_asn,
-                                                     guard_weights,
-                                                     usability_table)
-        client_guard_selection_probs[client_asn] = probs
+    return guard_selection_prob_matrix(usability_table, weight_vector, sparse)
 
-    return client_guard_selection_probs
+def guard_weight_vector(guard_fps, guard_weights):
+    """
+    Returns the guard_weights dict as a float array in guard_fps order.
+    """
+    return numpy.array([guard_weights[guard_fp] for guard_fp in guard_fps],
+                       dtype=numpy.float64)
+
+def guard_selection_prob_matrix(usability_table, weight_vector, sparse=False,
+                                block_rows=1024, out=None):
+    """
+    Vectorized get_guard_selection_probs_for_client() over every client.
+    Takes the boolean client x guard usability table and a vector of guard
+    weights, and returns the client x guard matrix of selection
+    probabilities: each row holds the client's usable guard weights
+    normalized to sum to one, or, where a client has no usable guard with
+    positive weight, the vanilla bandwidth weighting over all guards.
+
+    Rows are processed block_rows at a time.  If sparse is True the result is
+    built directly as a scipy.sparse CSR matrix holding only nonzero
+    probabilities, without a dense intermediate.  Otherwise the rows are
+    written to out if given, e.g. a numpy.memmap from
+    entropy_analysis.open_prob_matrix(), and out is returned.
+    """
+    usability_table = numpy.asarray(usability_table, dtype=bool)
+    weight_vector = numpy.asarray(weight_vector, dtype=numpy.float64)
+    num_clients, num_guards = usability_table.shape
+    vanilla_probs = weight_vector / weight_vector.sum()
+
+    if sparse:
+        import scipy.sparse
+        positive_weight = weight_vector > 0.
+        blocks = []
+    elif out is not None:
+        prob_matrix = out
+    else:
+        prob_matrix = numpy.empty((num_clients, num_guards))
+
+    for start in range(0, num_clients, block_rows):
+        usable = usability_table[start:start + block_rows]
+        safe_sums = usable.dot(weight_vector)
+        fallback = safe_sums == 0.
+
+        if sparse:
+            mask = usable & positive_weight
+            mask[fallback] = positive_weight
+            rows, cols = numpy.nonzero(mask)
+            norms = numpy.where(fallback, weight_vector.sum(), safe_sums)
+            blocks.append(scipy.sparse.csr_matrix(
+                (weight_vector[cols] / norms[rows], (rows, cols)),
+                shape=usable.shape))
+        else:
+            block = prob_matrix[start:start + block_rows]
+            numpy.multiply(usable, weight_vector, out=block)
+            block /= numpy.where(fallback, 1., safe_sums)[:, numpy.newaxis]
+            block[fallback] = vanilla_probs
+
+    if sparse:
+        if len(blocks) == 0:
+            return scipy.sparse.csr_matrix((num_clients, num_guards))
+        return scipy.sparse.vstack(blocks, format="csr")
+
+    return prob_matrix
+
+def load_guards(network_state_filename, pfx_tree):
+    """
+    Returns (guard_fps, guard_fp_to_asns, guard_weights) for the guards in the
+    network state file whose AS could be determined.
+    """
+
+    table, bw_weights, bwweightscale =\
+        relays.fat_network_state_relay_table(network_state_filename)
 
-def get_guard_selection_probs_for_client(guard_fps, client_asn, guard_weights,
-                                         usability_table):
+    guard_mask = table.get_guards()
 
-    safe_guard_fps = list(filter(lambda x: usability_table[(client_asn, x)],
-                                 guard_fps))
+    guard_fp_to_ip = dict(zip(table.fingerprints[guard_mask].tolist(),
+                              table.address_strings(guard_mask)))
+
+    guard_fp_to_asns =\
+            relays.make_relay_fp_to_asns_dict(guard_fp_to_ip, pfx_tree)
+
+    known_asns = numpy.array([guard_fp_to_asns[guard_fp] is not None for
+                              guard_fp in guard_fp_to_ip], dtype=bool)
+    guard_mask[guard_mask] = known_asns
+
+    guard_fps = table.fingerprints[guard_mask].tolist()
+    guard_weights = dict(zip(guard_fps,
+                             table.position_weights(guard_mask, 'g',
+                                                    bw_weights,
+                                                    bwweightscale).tolist()))
+
+    return guard_fps, guard_fp_to_asns, guard_weights
+
+def get_guard_selection_probs_for_client(guard_fps, usable_guards,
+                                         guard_weights):
+    """
+    usable_guards is the client's row of the usability table, i.e. one bool
+    per guard in guard_fps order.
+    """
+
+    safe_guard_fps = [guard_fp for guard_fp, usable in
+                      zip(guard_fps, usable_guards) if usable]
 
     bw_sum = sum(map(lambda x: guard_weights[x], safe_guard_fps))
 
@@ -96,31 +267,89 @@ def get_guard_selection_probs_for_client(guard_fps, client_asn, guard_weights,
 def make_client_guard_usability_table(client_asns, guard_fps, guard_fp_to_asns,
                                       pfi):
     """
-    Creates a dict mapping (client_asn, guard_fp) to bool values.  Value is True
-    if a client can use a guard according to DeNASA's no-suspect-on-ingress
+    Returns a boolean numpy matrix with one row per client AS (in client_asns
+    order) and one column per guard (in guard_fps order).  A cell is True if
+    the client can use the guard according to DeNASA's no-suspect-on-ingress
     policy, False otherwise.
+
+    Paths are looked up once per (client AS, guard AS) pair and the results
+    are fanned out to every guard in that AS.
     """
+    guard_asns = sorted({asn for guard_fp in guard_fps for asn in
+                         split_asns(guard_fp_to_asns[guard_fp])})
+    guard_asn_idxs = {asn: idx for idx, asn in enumerate(guard_asns)}
 
-    usability_table = dict()
+    guard_membership = make_guard_membership_matrix(guard_fps,
+                                                    guard_fp_to_asns,
+                                                    guard_asn_idxs)
+
+    inferred = numpy.zeros((len(client_asns), len(guard_asns)), dtype=bool)
+    suspect_on_path = numpy.zeros((len(client_asns), len(guard_asns)),
+                                  dtype=bool)
+
+    for idx, client_asn in enumerate(client_asns):
+        inferred[idx], suspect_on_path[idx] =\
+            suspects_on_paths_to_asns(client_asn, guard_asns, pfi)
+
+    return usability_from_asn_flags(guard_membership, inferred,
+                                    suspect_on_path)
+
+def make_guard_membership_matrix(guard_fps, guard_fp_to_asns, guard_asn_idxs):
+    """
+    Returns a boolean guard x guard AS matrix whose cell (g, a) is True if
+    guard g is (partly) in the guard AS with index a in guard_asn_idxs.
+    """
+    guard_membership = numpy.zeros((len(guard_fps), len(guard_asn_idxs)),
+                                   dtype=bool)
+    for idx, guard_fp in enumerate(guard_fps):
+        for asn in split_asns(guard_fp_to_asns[guard_fp]):
+            guard_membership[idx, guard_asn_idxs[asn]] = True
+    return guard_membership
+
+def usability_from_asn_flags(guard_membership, inferred, suspect_on_path):
+    """
+    Fans client x guard AS flags out to a client x guard usability table.  A
+    guard is usable if a path to at least one of its ASes could be inferred
+    and no inferred path to any of its ASes has a suspect on it.
+    """
+    # Boolean matrix products are ORs of ANDs, i.e. "any AS of the guard".
+    any_inferred = inferred.dot(guard_membership.T)
+    any_suspect = suspect_on_path.dot(guard_membership.T)
+    return any_inferred & ~any_suspect
+
+def split_asns(asns):
+    """
+    Splits a pfx2as origin string into ASNs; multi-origin prefixes ("X_Y")
+    and AS sets ("X,Y") yield every ASN.  Other iterables are listed as is.
+    """
+    if isinstance(asns, str):
+        return re.split("[_,]", asns)
+    return list(asns)
 
-    for client_asn in client_asns:
-        for guard_fp in guard_fps:
-            guard_asns = guard_fp_to_asns[guard_fp]
-            lookup = lambda x: bidirectional_lookup(client_asn, x, pfi)
-            suspects = union_of_non_none_sets(map(lookup, guard_asns))
+def suspects_on_paths_to_asns(client_asn, asns, pfi):
+    """
+    Looks up the forward and reverse paths between client_asn and every AS in
+    asns with two batched PFI lookups.  Returns two bool arrays aligned with
+    asns: whether any path could be inferred, and whether any inferred path
+    contains a SUSPECTS AS.
+    """
+    forward_paths = pfi.get_paths([(client_asn, asn) for asn in asns])
+    reverse_paths = pfi.get_paths([(asn, client_asn) for asn in asns])
 
-            table_key = (client_asn, guard_fp)
+    inferred = numpy.zeros(len(asns), dtype=bool)
+    suspect_on_path = numpy.zeros(len(asns), dtype=bool)
 
-            if len(suspects) == 0:
-                # No path inference could be performed
-                usability_table[table_key] = False
-            elif (len(suspects & SUSPECTS) != 0):
-                # Suspect on path
-                usability_table[table_key] = False
-            else:
-                usability_table[table_key] = True
+    for idx, (forward_path, reverse_path) in enumerate(zip(forward_paths,
+                                                           reverse_paths)):
+        ases_on_paths = union_of_non_none_sets(
+            [None if p is None else set(p) for p in (forward_path,
+                                                     reverse_path)])
+        if len(ases_on_paths) != 0:
+            inferred[idx] = True
+            if len(ases_on_paths & SUSPECTS) != 0:
+                suspect_on_path[idx] = True
 
-    return usability_table
+    return inferred, suspect_on_path
 
 def union_of_non_none_sets(sets):
     """
@@ -129,3 +358,109 @@ def union_of_non_none_sets(sets):
     """
     return functools.reduce(lambda x, y: x.union(y), filter(lambda z: z is not\
                                                             None, sets), set())
+
+class IncrementalGuardSelection(object):
+    """
+    Computes DeNASA guard selection probability matrices for a fixed list of
+    client ASes over a sequence of network states, e.g. consecutive hourly
+    consensuses.
+
+    Path-based flags are kept per (client AS, guard AS) pair across updates,
+    so each update only looks up paths to guard ASes not seen before.  The
+    usability table is re-derived from those flags only when the guards or
+    their ASes change, and probabilities are recomputed only when the
+    usability table or the position-weighted bandwidths change.
+    """
+    def __init__(self, client_asns, pfx_tree, pfi):
+        self._client_asns = list(client_asns)
+        self._pfx_tree = pfx_tree
+        self._pfi = pfi
+
+        self._guard_asn_idxs = dict()
+        self._inferred = numpy.zeros((len(self._client_asns), 0), dtype=bool)
+        self._suspect_on_path = numpy.zeros((len(self._client_asns), 0),
+                                            dtype=bool)
+
+        self._guard_fp_to_asns = None
+        self._guard_fps = None
+        self._usability_table = None
+        self._weight_vector = None
+        self._prob_matrix = None
+
+    def _add_guard_asns(self, guard_asns):
+        new_asns = sorted(set(guard_asns) - set(self._guard_asn_idxs.keys()))
+        if len(new_asns) == 0:
+            return
+
+        inferred = numpy.zeros((len(self._client_asns), len(new_asns)),
+                               dtype=bool)
+        suspect_on_path = numpy.zeros((len(self._client_asns), len(new_asns)),
+                                      dtype=bool)
+
+        for idx, client_asn in enumerate(self._client_asns):
+            inferred[idx], suspect_on_path[idx] =\
+                suspects_on_paths_to_asns(client_asn, new_asns, self._pfi)
+
+        for asn in new_asns:
+            self._guard_asn_idxs[asn] = len(self._guard_asn_idxs)
+
+        self._inferred = numpy.hstack([self._inferred, inferred])
+        self._suspect_on_path = numpy.hstack([self._suspect_on_path,
+                                              suspect_on_path])
+
+    def update(self, network_state_filename):
+        """
+        Returns (guard_fps, prob_matrix) for the network state file, as
+        compute_denasa_guard_selection_prob_matrix() would.  prob_matrix is
+        returned again by later updates that change nothing, so copy it
+        before modifying it.
+        """
+        guard_fps, guard_fp_to_asns, guard_weights =\
+            load_guards(network_state_filename, self._pfx_tree)
+        return self.update_guards(guard_fps, guard_fp_to_asns, guard_weights)
+
+    def update_guards(self, guard_fps, guard_fp_to_asns, guard_weights):
+        """
+        Like update(), but takes the output of load_guards() directly.
+        """
+        guard_fps = sorted(guard_fps)
+        guard_fp_to_asns = {guard_fp: split_asns(guard_fp_to_asns[guard_fp])
+                            for guard_fp in guard_fps}
+        weight_vector = guard_weight_vector(guard_fps, guard_weights)
+
+        guards_changed = (guard_fps != self._guard_fps or
+                          guard_fp_to_asns != self._guard_fp_to_asns)
+
+        if guards_changed:
+            num_known_asns = len(self._guard_asn_idxs)
+            self._add_guard_asns([asn for asns in guard_fp_to_asns.values()
+                                  for asn in asns])
+            logging.info("Looked up paths to {} new guard ASes.".format(
+                len(self._guard_asn_idxs) - num_known_asns))
+
+            guard_membership =\
+                make_guard_membership_matrix(guard_fps, guard_fp_to_asns,
+                                             self._guard_asn_idxs)
+            usability_table =\
+                usability_from_asn_flags(guard_membership, self._inferred,
+                                         self._suspect_on_path)
+
+            usability_changed = (self._usability_table is None or
+                                 not numpy.array_equal(usability_table,
+                                                       self._usability_table))
+            self._guard_fps = guard_fps
+            self._guard_fp_to_asns = guard_fp_to_asns
+            self._usability_table = usability_table
+        else:
+            usability_changed = False
+
+        if (usability_changed or self._weight_vector is None or
+            not numpy.array_equal(weight_vector, self._weight_vector)):
+            self._weight_vector = weight_vector
+            self._prob_matrix =\
+                guard_selection_prob_matrix(self._usability_table,
+                                            weight_vector)
+        else:
+            logging.info("Guards and weights unchanged; reusing matrix.")
+
+        return self._guard_fps, self._prob_matrix
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Compact, pre-parsed sidecar files for fat network state files.
+
+Parsing a fat network state file with stem takes seconds; its sidecar holds
+just what tempest reads from it and loads in milliseconds.  A sidecar is an
+uncompressed .npz archive, one array per column:
+
+    format, version             FORMAT and VERSION
+    fingerprints                relay fingerprints, in consensus order
+    addresses                   IPv4 addresses as uint32
+    flag_names                  consensus flags, indexed by the bits of...
+    flags                       ...one uint64 flag bitmask per relay
+    bandwidths                  consensus bandwidths
+    families                    UTF-8 bytes: each relay's space-separated
+                                descriptor family entries, one relay per line
+    valid_after, fresh_until    UNIX timestamps
+    bw_weight_names             bandwidth weight names (Wgg, Wgd, ...)
+    bw_weight_values            and their values
+    bwweightscale
+    hibernating_timestamps      the hibernating statuses, one column per
+    hibernating_fingerprints    tuple element
+    hibernating_flags
+
+Only relays that are in both the consensus and the descriptors are stored,
+which are the relays fat_network_state() puts in cons_rel_stats.
+"""
+
+import collections
+import ipaddress
+import os
+
+import numpy
+
+from . import relay_table
+
+FORMAT = "tempest-network-state"
+VERSION = 1
+
+CACHE_DIR = "cache"
+
+# Stand-ins for the stem router status entries and server descriptors that
+# fat_network_state() returns, holding only the fields tempest uses.
+CachedRouterStatus = collections.namedtuple("CachedRouterStatus",
+                                            ["fingerprint", "address",
+                                             "flags", "bandwidth"])
+
+CachedDescriptor = collections.namedtuple("CachedDescriptor",
+                                          ["fingerprint", "family"])
+
+def cache_filename(ns_filename):
+    """
+    Returns the sidecar path for a network state file: the file's name plus
+    .npz, in a CACHE_DIR subdirectory so directory listings of network state
+    files do not pick it up.
+    """
+    ns_dir, ns_basename = os.path.split(ns_filename)
+    return os.path.join(ns_dir, CACHE_DIR, ns_basename + ".npz")
+
+def write_cache(network_state, filename):
+    """
+    Writes the tuple returned by fat_network_state() to a sidecar file.
+    """
+    (cons_rel_stats, descriptors, cons_valid_after, cons_fresh_until,
+     cons_bw_weights, cons_bwweightscale, hibernating_statuses) = network_state
+
+    table = relay_table.RelayTable.from_network_state(cons_rel_stats,
+                                                      descriptors)
+    fingerprints = table.fingerprints.tolist()
+
+    families = [" ".join(sorted(getattr(descriptors[fprint], "family", None)
+                                or ())) for fprint in fingerprints]
+
+    if len(hibernating_statuses) > 0:
+        hibernating_columns = [numpy.array(column) for column in
+                               zip(*hibernating_statuses)]
+    else:
+        hibernating_columns = [numpy.array([])] * 3
+
+    bw_weight_names = sorted(cons_bw_weights.keys())
+
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp_filename = filename + ".tmp"
+
+    with open(tmp_filename, "wb") as cache_file:
+        numpy.savez(
+            cache_file,
+            format=numpy.array(FORMAT),
+            version=numpy.array(VERSION),
+            fingerprints=numpy.char.encode(table.fingerprints, "ascii"),
+            addresses=table.addresses,
+            flag_names=numpy.array(table.flag_names, dtype=str),
+            flags=table.flags,
+            bandwidths=table.bandwidths,
+            families=numpy.frombuffer("\n".join(families).encode("utf-8"),
+                                      dtype=numpy.uint8),
+            valid_after=numpy.array(cons_valid_after, dtype=numpy.int64),
+            fresh_until=numpy.array(cons_fresh_until, dtype=numpy.int64),
+            bw_weight_names=numpy.array(bw_weight_names, dtype=str),
+            bw_weight_values=numpy.array([cons_bw_weights[name] for name in
+                                          bw_weight_names],
+                                         dtype=numpy.int64),
+            bwweightscale=numpy.array(cons_bwweightscale,
+                                      dtype=numpy.int64),
+            hibernating_timestamps=hibernating_columns[0],
+            hibernating_fingerprints=hibernating_columns[1],
+            hibernating_flags=hibernating_columns[2])
+
+    os.replace(tmp_filename, filename)
+
+def read_cache_columns(filename):
+    """
+    Returns a sidecar's columns as a dict of numpy arrays.  Raises ValueError
+    if the file is not a sidecar of the current VERSION.
+    """
+    with numpy.load(filename, allow_pickle=False) as cache_file:
+        columns = {name: cache_file[name] for name in cache_file.files}
+
+    if "format" not in columns or str(columns["format"]) != FORMAT:
+        raise ValueError("{} is not a network state sidecar".format(filename))
+    if int(columns["version"]) != VERSION:
+        raise ValueError("Unsupported network state sidecar version {}".format(
+            int(columns["version"])))
+
+    return columns
+
+def read_cache(filename):
+    """
+    Returns the same tuple as fat_network_state() from a sidecar file, with
+    CachedRouterStatus and CachedDescriptor values in place of stem objects.
+    """
+    columns = read_cache_columns(filename)
+
+    flag_names = columns["flag_names"].tolist()
+    flag_bits = [(flag, 1 << bit) for bit, flag in enumerate(flag_names)]
+
+    cons_rel_stats = dict()
+    descriptors = dict()
+
+    fingerprints = columns["fingerprints"].astype(str).tolist()
+    families = columns["families"].tobytes().decode("utf-8").split("\n")
+
+    for fprint, address, flags, bandwidth, family in zip(
+            fingerprints, columns["addresses"].tolist(),
+            columns["flags"].tolist(), columns["bandwidths"].tolist(),
+            families):
+        cons_rel_stats[fprint] = CachedRouterStatus(
+            fprint, str(ipaddress.IPv4Address(address)),
+            [flag for flag, bit in flag_bits if flags & bit], bandwidth)
+        descriptors[fprint] = CachedDescriptor(fprint, set(family.split()))
+
+    cons_bw_weights = dict(zip(columns["bw_weight_names"].tolist(),
+                               columns["bw_weight_values"].tolist()))
+
+    hibernating_statuses = list(zip(
+        columns["hibernating_timestamps"].tolist(),
+        columns["hibernating_fingerprints"].tolist(),
+        columns["hibernating_flags"].tolist()))
+
+    return (cons_rel_stats, descriptors, int(columns["valid_after"]),
+            int(columns["fresh_until"]), cons_bw_weights,
+            int(columns["bwweightscale"]), hibernating_statuses)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Columnar relay table for a consensus: parallel numpy arrays of fingerprints,
+IPv4 addresses, flag bitmasks and bandwidths, with vectorized versions of the
+guard filters and position weights in relays.
+"""
+
+import ipaddress
+
+import numpy
+from stem import Flag
+
+class RelayTable(object):
+    """
+    Relays in consensus order.  flags[i] has bit b set if relay i has flag
+    flag_names[b].  has_descriptor[i] is True if the network state has a
+    server descriptor for relay i.
+    """
+
+    def __init__(self, fingerprints, addresses, flag_names, flags, bandwidths,
+                 has_descriptor=None):
+        self.fingerprints = numpy.asarray(fingerprints, dtype=str)
+        self.addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+        self.flag_names = list(flag_names)
+        self.flags = numpy.asarray(flags, dtype=numpy.uint64)
+        self.bandwidths = numpy.asarray(bandwidths, dtype=numpy.int64)
+
+        if has_descriptor is None:
+            has_descriptor = numpy.ones(len(self.fingerprints), dtype=bool)
+        self.has_descriptor = numpy.asarray(has_descriptor, dtype=bool)
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    @staticmethod
+    def from_network_state(cons_rel_stats, descriptors):
+        """
+        Builds a table from the cons_rel_stats and descriptors returned by
+        relays.fat_network_state().
+        """
+        fingerprints = list(cons_rel_stats.keys())
+        flag_names = sorted({flag for fprint in fingerprints for flag in
+                             cons_rel_stats[fprint].flags})
+
+        if len(flag_names) > 64:
+            raise ValueError("Too many distinct flags for a uint64 bitmask")
+
+        flag_bits = {flag: 1 << bit for bit, flag in enumerate(flag_names)}
+        flags = [sum(flag_bits[flag] for flag in
+                     set(cons_rel_stats[fprint].flags)) for fprint in
+                 fingerprints]
+
+        return RelayTable(
+            fingerprints,
+            [int(ipaddress.IPv4Address(cons_rel_stats[fprint].address)) for
+             fprint in fingerprints],
+            flag_names,
+            numpy.array(flags, dtype=numpy.uint64),
+            [cons_rel_stats[fprint].bandwidth for fprint in fingerprints],
+            [fprint in descriptors for fprint in fingerprints])
+
+    @staticmethod
+    def from_cache_columns(columns):
+        """
+        Builds a table from network_state_cache.read_cache_columns().
+        """
+        return RelayTable(columns["fingerprints"].astype(str),
+                          columns["addresses"],
+                          columns["flag_names"].tolist(),
+                          columns["flags"],
+                          columns["bandwidths"])
+
+    def flag_mask(self, *flags):
+        """
+        Returns a bool array, True for relays that have all of flags.
+        """
+        bits = 0
+        for flag in flags:
+            if flag not in self.flag_names:
+                return numpy.zeros(len(self), dtype=bool)
+            bits |= 1 << self.flag_names.index(flag)
+
+        bits = numpy.uint64(bits)
+        return (self.flags & bits) == bits
+
+    def filter_guards(self):
+        """
+        Vectorized relays.pathsim_filter_guards(): a bool array, True for
+        relays with the Running, Valid and Guard flags and a descriptor.
+        """
+        return self.flag_mask(Flag.RUNNING, Flag.VALID, Flag.GUARD) &\
+            self.has_descriptor
+
+    def get_guards(self):
+        """
+        Vectorized relays.get_guards(): filter_guards() plus the Fast flag.
+        """
+        return self.filter_guards() & self.flag_mask(Flag.FAST)
+
+    def position_weights(self, mask, position, bw_weights, bwweightscale):
+        """
+        Vectorized relays.pathsim_get_position_weights() over the relays
+        selected by the bool array mask; returns a float array aligned with
+        numpy.nonzero(mask)[0].
+        """
+        if position != 'g':
+            raise NotImplementedError()
+
+        guard = self.flag_mask(Flag.GUARD)[mask]
+        exit_ = self.flag_mask(Flag.EXIT)[mask]
+
+        if numpy.any(exit_ & ~guard):
+            raise ValueError('Wge weight does not exist.')
+
+        weights = numpy.where(guard & exit_, float(bw_weights['Wgd']),
+                              numpy.where(guard, float(bw_weights['Wgg']),
+                                          float(bw_weights['Wgm'])))
+
+        return self.bandwidths[mask].astype(numpy.float64) *\
+            (weights / float(bwweightscale))
+
+    def address_strings(self, mask):
+        """
+        Returns the dotted-quad addresses of the relays selected by mask.
+        """
+        return [str(ipaddress.IPv4Address(address)) for address in
+                self.addresses[mask].tolist()]
@@ -43,16 +43,21 @@ compatibility.
 # RESULTING FROM THE USE OF THIS SOFTWARE.
 ################################################################################
 
+import collections.abc
 import datetime
 from io import BytesIO
 import ipaddress
+import logging
+import os
 import pickle
 import re
 
 from stem import Flag
 import stem.descriptor
 
-from .. import util
+from . import network_state_cache
+from . import relay_table
+from ..datetime_index import DatetimeIndex
 
 DEFAULT_BWWEIGHTSCALE = 10000
 
@@ -61,9 +66,102 @@ NSF_REGEX =\
 
 NSF_TIME_FORMAT = "%Y-%m-%d-%H-%M-%S"
 
-def fat_network_state(ns_filename):
+NSF_INDEX_FILENAME = "network_state_index.tsv"
+
+class LazyDescriptors(collections.abc.Mapping):
+    """Maps fingerprints to server descriptors like the dict built by
+    fat_network_state(), but keeps each descriptor's raw bytes and parses it
+    with stem only when it is first looked up.  Membership tests, len() and
+    iteration never parse."""
+
+    def __init__(self, raw_descriptors):
+        self._raw_descriptors = raw_descriptors
+        self._parsed_descriptors = dict()
+
+    def __getitem__(self, fprint):
+        desc = self._parsed_descriptors.get(fprint)
+        if desc is None:
+            desc = parse_descriptor(self._raw_descriptors[fprint])
+            self._parsed_descriptors[fprint] = desc
+        return desc
+
+    def __contains__(self, fprint):
+        return fprint in self._raw_descriptors
+
+    def __iter__(self):
+        return iter(self._raw_descriptors)
+
+    def __len__(self):
+        return len(self._raw_descriptors)
+
+def parse_descriptor(desc_str):
+    """Parses one server descriptor entry of a fat network state file."""
+    i = 0
+    for desc in stem.descriptor.parse_file(BytesIO(desc_str), validate = True):
+        if (i > 0):
+            raise ValueError('Unexpectedly found more than one descriptor in dict entry')
+        i += 1
+    return desc
+
+def fat_network_state(ns_filename, use_cache=True, lazy_descriptors=False):
     """Reading fat network state file into commonly-used variables.
-    Cannot use pathsim.get_network_state() because nsf is fat."""
+    Cannot use pathsim.get_network_state() because nsf is fat.
+    If use_cache is True and the file has an up-to-date sidecar written by
+    cache_fat_network_state(), the sidecar is read instead of parsing the
+    file with stem; see network_state_cache for what it holds.
+    If lazy_descriptors is True, a file parsed with stem returns its
+    descriptors as a LazyDescriptors mapping, so descriptors that are never
+    looked up are never parsed (and errors in them never raised)."""
+    cache_fname = fresh_cache_filename(ns_filename) if use_cache else None
+    if cache_fname is not None:
+        try:
+            return network_state_cache.read_cache(cache_fname)
+        except ValueError as e:
+            logging.warning("Ignoring sidecar {}: {}".format(cache_fname, e))
+
+    return parse_fat_network_state(ns_filename, lazy_descriptors)
+
+def fat_network_state_relay_table(ns_filename, use_cache=True):
+    """Returns (relay_table, cons_bw_weights, cons_bwweightscale) for a fat
+    network state file, where relay_table is a relay_table.RelayTable of the
+    relays fat_network_state() puts in cons_rel_stats.  Built straight from
+    the sidecar's columns when one is available."""
+    cache_fname = fresh_cache_filename(ns_filename) if use_cache else None
+    if cache_fname is not None:
+        try:
+            columns = network_state_cache.read_cache_columns(cache_fname)
+            return (relay_table.RelayTable.from_cache_columns(columns),
+                    dict(zip(columns["bw_weight_names"].tolist(),
+                             columns["bw_weight_values"].tolist())),
+                    int(columns["bwweightscale"]))
+        except ValueError as e:
+            logging.warning("Ignoring sidecar {}: {}".format(cache_fname, e))
+
+    network_state = parse_fat_network_state(ns_filename, lazy_descriptors=True)
+    return (relay_table.RelayTable.from_network_state(network_state[0],
+                                                      network_state[1]),
+            network_state[4], network_state[5])
+
+def fresh_cache_filename(ns_filename):
+    """Returns the sidecar filename for a fat network state file, or None if
+    it has no sidecar at least as new as the file."""
+    cache_fname = network_state_cache.cache_filename(ns_filename)
+    if (os.path.exists(cache_fname) and
+        os.path.getmtime(cache_fname) >= os.path.getmtime(ns_filename)):
+        return cache_fname
+    return None
+
+def cache_fat_network_state(ns_filename):
+    """Parses a fat network state file with stem and writes its sidecar.
+    Returns the sidecar filename."""
+    cache_fname = network_state_cache.cache_filename(ns_filename)
+    network_state = parse_fat_network_state(ns_filename,
+                                            lazy_descriptors=True)
+    network_state_cache.write_cache(network_state, cache_fname)
+    return cache_fname
+
+def parse_fat_network_state(ns_filename, lazy_descriptors=False):
+    """fat_network_state() without the sidecar."""
     cons_rel_stats = {}
     with open(ns_filename, 'rb') as nsf:
         consensus_str = pickle.load(nsf, encoding='bytes')
@@ -78,13 +176,9 @@ def fat_network_state(ns_filename):
             i += 1
         # convert descriptors from strings to stem objets
         descriptors = pickle.load(nsf, encoding='bytes')
-        for fprint, desc_str in descriptors.items():
-            i = 0
-            for desc in stem.descriptor.parse_file(BytesIO(desc_str), validate = True):
-                if (i > 0):
-                    raise ValueError('Unexpectedly found more than one descriptor in dict entry')
-                descriptors[fprint] = desc
-                i += 1
+        if not lazy_descriptors:
+            for fprint, desc_str in descriptors.items():
+                descriptors[fprint] = parse_descriptor(desc_str)
         hibernating_statuses = pickle.load(nsf, encoding='bytes')
 
     # descriptor conversion
@@ -93,6 +187,8 @@ def fat_network_state(ns_filename):
         converted_descriptors[fprint.decode('utf-8')] = descriptor
 
     descriptors = converted_descriptors
+    if lazy_descriptors:
+        descriptors = LazyDescriptors(descriptors)
 
     # set variables from consensus
     cons_valid_after = pathsim_timestamp(consensus.valid_after)
@@ -110,13 +206,33 @@ def fat_network_state(ns_filename):
     return (cons_rel_stats, descriptors, cons_valid_after, cons_fresh_until,
         cons_bw_weights, cons_bwweightscale, hibernating_statuses)
 
-def fat_network_state_for_datetime(nsf_dir, ns_datetime):
-    nsf_fnames = util.get_all_filenames_by_regex(nsf_dir, NSF_REGEX)
-    for nsf_fname in nsf_fnames:
-        if (util.str_to_datetime_by_regex(nsf_fname, NSF_REGEX, NSF_TIME_FORMAT)
-            == ns_datetime):
-            return fat_network_state(nsf_fname)
-    return None
+def fat_network_state_for_datetime(nsf_dir, ns_datetime, nearest_before=False,
+                                   persist_index=False):
+    """Returns fat_network_state() of the file for ns_datetime, or if
+    nearest_before is True, of the latest file at or before ns_datetime.
+    Returns None if there is no such file.  See nsf_index() for
+    persist_index."""
+    index = nsf_index(nsf_dir, persist_index)
+    if nearest_before:
+        entry = index.nearest_before(ns_datetime)
+        nsf_fname = entry[1] if entry is not None else None
+    else:
+        nsf_fname = index.exact(ns_datetime)
+
+    if nsf_fname is None:
+        return None
+    return fat_network_state(nsf_fname)
+
+def nsf_index(nsf_dir, persist=False):
+    """Returns the DatetimeIndex of the network state files in nsf_dir.  If
+    persist is True the index is also stored in, and reused from, the
+    directory's sidecar subdirectory."""
+    index_filename = None
+    if persist:
+        index_filename = os.path.join(nsf_dir, network_state_cache.CACHE_DIR,
+                                      NSF_INDEX_FILENAME)
+    return DatetimeIndex.for_directory(nsf_dir, NSF_REGEX, NSF_TIME_FORMAT,
+                                       index_filename)
 
 def get_guards(cons_rel_stats, descriptors):
     """Returns guards in cons_rel_stats. FAST flag required.
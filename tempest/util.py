@@ -4,6 +4,8 @@ import datetime
 import os
 import re
 
+from .datetime_index import DatetimeIndex
+
 def dict_keys_str_to_datetime(the_dict, compiled_regex, time_format):
     new_dict = dict()
     for old_key, val in the_dict.items():
@@ -17,14 +19,15 @@ def get_all_filenames_by_regex(directory, compiled_regex):
                        all_filenames)))
 
 def get_all_filenames_in_date_range(directory, compiled_regex, time_format,
-                                    start_date, end_date):
-    def fname_in_range(fname):
-        fname_datetime = str_to_datetime_by_regex(fname, compiled_regex,
-                                                  time_format)
-        return (fname_datetime >= start_date and fname_datetime < end_date)
-
-    return [f for f in get_all_filenames_by_regex(directory, compiled_regex) if
-            fname_in_range(f)]
+                                    start_date, end_date, index_filename=None):
+    """
+    Returns the files in directory dated start_date <= date < end_date, in
+    date order, from the directory's DatetimeIndex, persisted to
+    index_filename if given.
+    """
+    index = DatetimeIndex.for_directory(directory, compiled_regex, time_format,
+                                        index_filename)
+    return index.range(start_date, end_date)
 
 # Ripped from pycomnrl.file_system
 def get_all_filenames_in_directory(directory):
@@ -0,0 +1,85 @@
+import numpy
+import pytest
+
+from tempest.tor import entropy_analysis
+
+def reference_dissim_scores(prob_matrix):
+    """
+    The original O(num_clients^2 * num_guards) score_clients_by_dissim().
+    """
+    num_client_asns, num_guards = prob_matrix.shape
+    scores = []
+    for idx in range(num_client_asns):
+        acc = 0.0
+        row = prob_matrix[idx]
+        for jdx in range(num_guards):
+            acc += numpy.sum(numpy.abs(numpy.subtract(prob_matrix[:, jdx],
+                                                      row[jdx])))
+        scores.append((idx, acc))
+    return scores
+
+def random_prob_matrix(rng, num_client_asns, num_guards, num_levels=None):
+    """
+    Row-stochastic matrix; with num_levels, cells are drawn from a few
+    values so columns have many ties.
+    """
+    if num_levels is None:
+        prob_matrix = rng.random((num_client_asns, num_guards))
+    else:
+        prob_matrix = rng.integers(0, num_levels,
+                                   (num_client_asns, num_guards)).astype(float)
+        prob_matrix[:, 0] += 1.
+    return prob_matrix / prob_matrix.sum(axis=1, keepdims=True)
+
+def assert_scores_match(scores, expected):
+    assert [idx for idx, _ in scores] == [idx for idx, _ in expected]
+    numpy.testing.assert_allclose([score for _, score in scores],
+                                  [score for _, score in expected],
+                                  rtol=1e-12, atol=1e-12)
+
+@pytest.mark.parametrize("num_levels", [None, 3])
+@pytest.mark.parametrize("block_columns", [1, 7, 512])
+@pytest.mark.parametrize("num_procs", [1, 3])
+def test_dissim_matches_reference(num_levels, block_columns, num_procs):
+    rng = numpy.random.default_rng(0)
+    prob_matrix = random_prob_matrix(rng, 40, 25, num_levels)
+
+    scores = entropy_analysis.score_clients_by_dissim(
+        prob_matrix, block_columns=block_columns, num_procs=num_procs,
+        shard_size=4)
+
+    assert_scores_match(scores, reference_dissim_scores(prob_matrix))
+
+@pytest.mark.parametrize("block_columns", [1, 4, 512])
+def test_dissim_all_zero_columns(block_columns):
+    rng = numpy.random.default_rng(1)
+    prob_matrix = random_prob_matrix(rng, 12, 10)
+    prob_matrix[:, [0, 3, 9]] = 0.
+
+    scores = entropy_analysis.score_clients_by_dissim(
+        prob_matrix, block_columns=block_columns)
+
+    assert_scores_match(scores, reference_dissim_scores(prob_matrix))
+
+@pytest.mark.parametrize("num_client_asns", [1, 2])
+@pytest.mark.parametrize("num_procs", [1, 2])
+def test_dissim_few_rows(num_client_asns, num_procs):
+    rng = numpy.random.default_rng(2)
+    prob_matrix = random_prob_matrix(rng, num_client_asns, 6)
+
+    scores = entropy_analysis.score_clients_by_dissim(
+        prob_matrix, block_columns=4, num_procs=num_procs, shard_size=2)
+
+    assert_scores_match(scores, reference_dissim_scores(prob_matrix))
+
+def test_dissim_float32():
+    rng = numpy.random.default_rng(3)
+    prob_matrix = random_prob_matrix(rng, 30, 20, 4)
+
+    scores = entropy_analysis.score_clients_by_dissim(
+        prob_matrix, block_columns=8, dtype=numpy.float32)
+
+    expected = reference_dissim_scores(prob_matrix)
+    numpy.testing.assert_allclose([score for _, score in scores],
+                                  [score for _, score in expected],
+                                  rtol=1e-5)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Sweeps DeNASA over every network state file in a date range and writes each
+client's dissimilarity and entropy scores per consensus to a tab-separated
+table with the columns in OUTPUT_COLUMNS, which pandas.read_csv(..., sep="\t")
+loads column by column.  One network state is held in memory at a time.  Each
+consensus's rows are appended and synced together, so an interrupted run
+resumes after the last consensus in the output file; a binary columnar file
+could not be extended or checked one consensus at a time.
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+import tempest.pfi
+from tempest import ip_to_asn
+from tempest.tor import denasa
+from tempest.tor import entropy_analysis
+from tempest.tor import relays
+
+OUTPUT_COLUMNS = ["consensus", "client_asn", "dissimilarity", "entropy"]
+
+DATE_FORMAT = "%Y-%m-%d"
+
+def completed_consensuses(output_filename, client_asns):
+    """
+    Returns the set of consensus strings already scored in the output file.
+    Every block of rows must list client_asns in order; only the trailing
+    block may be incomplete, in which case it is truncated.  Raises
+    ValueError if the file was written for a different list of clients.
+    """
+    completed = set()
+    mismatch = "Rows for {{}} in {} do not match the {} client ASes".format(
+        output_filename, len(client_asns))
+
+    if not os.path.exists(output_filename):
+        return completed
+
+    with open(output_filename, "r+") as output_file:
+        valid_length = 0
+        block_consensus = None
+        block_rows = 0
+        offset = 0
+
+        for line in output_file:
+            offset += len(line.encode("ascii"))
+
+            if not line.endswith("\n"):
+                break
+
+            fields = line.rstrip("\n").split("\t")
+            if fields == OUTPUT_COLUMNS:
+                valid_length = offset
+                continue
+
+            if fields[0] != block_consensus:
+                if 0 < block_rows < len(client_asns):
+                    raise ValueError(mismatch.format(block_consensus))
+                block_consensus = fields[0]
+                block_rows = 0
+
+            if len(fields) != len(OUTPUT_COLUMNS) or\
+               block_rows >= len(client_asns) or\
+               fields[1] != client_asns[block_rows]:
+                raise ValueError(mismatch.format(block_consensus))
+
+            block_rows += 1
+            if block_rows == len(client_asns):
+                completed.add(block_consensus)
+                valid_length = offset
+
+        if valid_length < offset:
+            logging.info("Discarding {} bytes of partial output.".format(
+                offset - valid_length))
+            output_file.truncate(valid_length)
+
+    return completed
+
+def write_consensus_scores(output_file, consensus, client_asns, dissim_scores,
+                           entropy_scores):
+    rows = []
+    for idx, client_asn in enumerate(client_asns):
+        rows.append("{}\t{}\t{!r}\t{!r}\n".format(consensus, client_asn,
+                                                 float(dissim_scores[idx][1]),
+                                                 float(entropy_scores[idx][1])))
+    output_file.write("".join(rows))
+    output_file.flush()
+    os.fsync(output_file.fileno())
+
+def main(args):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    client_ases = read_clique_file(args.clique_filename)
+
+    pfi = tempest.pfi.PFI(args.libspookyhash_path,
+                          args.path_filename,
+                          args.index_filename,
+                          use_mmap=args.use_mmap,
+                          bloom_filename=args.bloom_filename)
+
+    pfi.load()
+    pfi.verify()
+
+    pfx_tree = ip_to_asn.prefix_tree_from_pfx2as_file(args.pfx2as_filename)
+
+    start_date = datetime.datetime.strptime(args.start_date, DATE_FORMAT)
+    end_date = datetime.datetime.strptime(args.end_date, DATE_FORMAT)
+
+    nsf_index = relays.nsf_index(args.nsf_dir, persist=args.persist_index)
+    nsf_filenames = nsf_index.range(start_date, end_date)
+
+    completed = completed_consensuses(args.output_filename, client_ases)
+    write_header = not os.path.exists(args.output_filename) or\
+        os.path.getsize(args.output_filename) == 0
+
+    guard_selection = denasa.IncrementalGuardSelection(client_ases, pfx_tree,
+                                                       pfi)
+
+    with open(args.output_filename, "a") as output_file:
+        if write_header:
+            output_file.write("\t".join(OUTPUT_COLUMNS) + "\n")
+
+        for nsf_filename in nsf_filenames:
+            consensus = relays.NSF_REGEX.match(nsf_filename).group(1)
+            if consensus in completed:
+                continue
+
+            logging.info("Scoring {}".format(consensus))
+
+            guard_fps, prob_matrix = guard_selection.update(nsf_filename)
+
+            dissim_scores =\
+                entropy_analysis.score_clients_by_dissim(prob_matrix)
+            entropy_scores =\
+                entropy_analysis.score_clients_by_entropy(prob_matrix)
+
+            write_consensus_scores(output_file, consensus, client_ases,
+                                   dissim_scores, entropy_scores)
+
+    pfi.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nsf_dir")
+    parser.add_argument("start_date", help="First day, YYYY-MM-DD")
+    parser.add_argument("end_date", help="Day after the last day, YYYY-MM-DD")
+    parser.add_argument("pfx2as_filename")
+    parser.add_argument("libspookyhash_path")
+    parser.add_argument("path_filename")
+    parser.add_argument("index_filename")
+    parser.add_argument("clique_filename")
+    parser.add_argument("output_filename")
+    parser.add_argument("--use-mmap", action="store_true",
+                        help="Memory-map the path and index files")
+    parser.add_argument("--bloom-filename",
+                        help="Bloom filter of the path file's keys")
+    parser.add_argument("--persist-index", action="store_true",
+                        help="Store the NSF directory index with the "
+                        "network state sidecars for reuse")
+    return parser.parse_args()
+
+def read_clique_file(clique_filename):
+    return [line.strip() for line in open(clique_filename, 'r') if
+            len(line.strip()) > 0]
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -17,33 +17,34 @@ def main(args):
 
     pfi = tempest.pfi.PFI(args.libspookyhash_path,
                           args.path_filename,
-                          args.index_filename)
+                          args.index_filename,
+                          use_mmap=args.use_mmap,
+                          use_pread=(args.num_procs > 1),
+                          bloom_filename=args.bloom_filename)
 
     pfi.load()
     pfi.verify()
 
     pfx_tree = ip_to_asn.prefix_tree_from_pfx2as_file(args.pfx2as_filename)
 
-    client_guard_selection_probs =\
-        denasa.compute_denasa_guard_selection_probs(
+    guard_fps, prob_matrix =\
+        denasa.compute_denasa_guard_selection_prob_matrix(
             client_ases,
             args.nsf_filename,
             pfx_tree,
-            pfi)
+            pfi,
+            num_procs=args.num_procs)
 
-    guard_fps = sorted(client_guard_selection_probs[client_ases[0]].keys())
-
-    prob_matrix = entropy_analysis.make_prob_matrix(client_ases, guard_fps,
-                                                    client_guard_selection_probs)
-
-    dissim_scores = entropy_analysis.score_clients_by_dissim(prob_matrix)
+    dissim_scores = entropy_analysis.score_clients_by_dissim(
+        prob_matrix, num_procs=args.num_procs)
     dissim_scores = sorted(dissim_scores, key=lambda x: x[1], reverse=True)
 
     print("* DISSIMILARITY *")
     for idx, score in dissim_scores:
         print(client_ases[idx], score)
 
-    entropy_scores = entropy_analysis.score_clients_by_entropy(prob_matrix)
+    entropy_scores = entropy_analysis.score_clients_by_entropy(
+        prob_matrix, num_procs=args.num_procs)
     entropy_scores = sorted(entropy_scores, key=lambda x: x[1], reverse=False)
 
     print("* ENTROPY *")
@@ -60,6 +61,13 @@ def parse_args():
     parser.add_argument("path_filename")
     parser.add_argument("index_filename")
     parser.add_argument("clique_filename")
+    parser.add_argument("--use-mmap", action="store_true",
+                        help="Memory-map the path and index files")
+    parser.add_argument("--num-procs", type=int, default=1,
+                        help="Worker processes for guard probabilities and "
+                        "scoring")
+    parser.add_argument("--bloom-filename",
+                        help="Bloom filter of the path file's keys")
     return parser.parse_args()
 
 def read_clique_file(clique_filename):
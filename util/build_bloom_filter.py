@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sys
+
+from tempest import bloom
+
+def main(args):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    bloom.build_bloom_filter(args.path_filename,
+                             args.bloom_filename,
+                             false_positive_rate=args.false_positive_rate)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_filename")
+    parser.add_argument("bloom_filename")
+    parser.add_argument("--false-positive-rate", type=float, default=0.01)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(parse_args())
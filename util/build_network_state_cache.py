@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import multiprocessing
+import sys
+
+from tempest.tor import relays
+
+def cache_network_state(nsf_filename):
+    cache_filename = relays.cache_fat_network_state(nsf_filename)
+    logging.info("Wrote {}".format(cache_filename))
+
+def main(args):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    index = relays.nsf_index(args.nsf_dir, persist=args.persist_index)
+    nsf_filenames = [nsf_filename for _, nsf_filename in index.items()]
+
+    with multiprocessing.Pool(args.num_procs) as pool:
+        for _ in pool.imap_unordered(cache_network_state, nsf_filenames):
+            pass
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nsf_dir")
+    parser.add_argument("--num-procs", type=int, default=1)
+    parser.add_argument("--persist-index", action="store_true",
+                        help="Also store the NSF directory index")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sys
+
+from tempest import pfi_builder
+
+def main(args):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    pfi_builder.build_index(args.path_filename,
+                            args.index_filename,
+                            num_procs=args.num_procs,
+                            chunk_lines=args.chunk_lines,
+                            use_mmap=args.use_mmap)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_filename")
+    parser.add_argument("index_filename")
+    parser.add_argument("--num-procs", type=int, default=1)
+    parser.add_argument("--chunk-lines", type=int, default=1 << 20)
+    parser.add_argument("--use-mmap", action="store_true",
+                        help="Fill the index through an mmap of the output")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sys
+
+from tempest import source_index
+
+def main(args):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    source_index.build_source_index(args.path_filename,
+                                    args.out_path_filename,
+                                    args.out_index_filename,
+                                    bucket_size=args.bucket_size,
+                                    tmp_dir=args.tmp_dir)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_filename")
+    parser.add_argument("out_path_filename")
+    parser.add_argument("out_index_filename")
+    parser.add_argument("--bucket-size", type=int, default=1 << 28,
+                        help="Approximate bytes of paths sorted in memory at "
+                        "once")
+    parser.add_argument("--tmp-dir",
+                        help="Directory for bucket files (default: the output "
+                        "directory)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -14,12 +14,26 @@ def are_neighbors(pfi, x, y):
     else:
         return True
 
+def neighborhood(pfi, x, candidates):
+    """
+    Returns the subset of candidates that are_neighbors() with x, using batched
+    PFI lookups.
+    """
+    candidates = list(candidates)
+    forward_paths = pfi.get_paths([(x, y) for y in candidates])
+    reverse_paths = pfi.get_paths([(y, x) for y in candidates])
+    return { y for y, forward_path, reverse_path in
+             zip(candidates, forward_paths, reverse_paths) if
+             not (forward_path == ['None'] or reverse_path == ['None']) }
+
 def main(args):
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
     pfi = tempest.pfi.PFI(args.libspookyhash_path,
                           args.path_filename,
-                          args.index_filename)
+                          args.index_filename,
+                          use_mmap=args.use_mmap,
+                          bloom_filename=args.bloom_filename)
     pfi.load()
     pfi.verify()
 
@@ -32,7 +46,7 @@ def main(args):
         if len(p) % 10 == 0:
             print("{} ASes left in p".format(len(p)), file=sys.stderr)
         v = p.pop()
-        v_nbhd = { n for n in p if are_neighbors(pfi, v, n) }
+        v_nbhd = neighborhood(pfi, v, p)
         if len(v_nbhd) >= (len(p) / 2):
             r.append(v)
             p.intersection_update(v_nbhd)
@@ -50,6 +64,10 @@ def parse_args():
     parser.add_argument("path_filename")
     parser.add_argument("index_filename")
     parser.add_argument("asrel_filename")
+    parser.add_argument("--use-mmap", action="store_true",
+                        help="Memory-map the path and index files")
+    parser.add_argument("--bloom-filename",
+                        help="Bloom filter of the path file's keys")
     return parser.parse_args()
 
 if __name__ == "__main__":
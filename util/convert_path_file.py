@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sys
+
+from tempest import path_store
+
+def main(args):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    if args.varint:
+        encoding = path_store.ENCODING_VARINT
+    else:
+        encoding = path_store.ENCODING_UINT32
+
+    path_store.convert_path_file(args.path_filename,
+                                 args.out_path_filename,
+                                 args.index_filename,
+                                 args.out_index_filename,
+                                 encoding)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_filename")
+    parser.add_argument("index_filename")
+    parser.add_argument("out_path_filename")
+    parser.add_argument("out_index_filename")
+    parser.add_argument("--varint", action="store_true",
+                        help="Varint-encode ASN ids instead of using uint32")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import random
+import sys
+
+import tempest.pfi
+from tempest import pfi_stats
+
+def main(args):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    pfi = tempest.pfi.PFI(args.libspookyhash_path,
+                          args.path_filename,
+                          args.index_filename,
+                          use_mmap=args.use_mmap,
+                          bloom_filename=args.bloom_filename)
+    pfi.load()
+    pfi.verify()
+
+    rng = random.Random(args.seed)
+    pairs = pfi_stats.sample_pairs(pfi, args.num_samples, rng)
+    report = pfi_stats.health_report(pfi, pairs)
+
+    print(pfi_stats.format_report(report))
+
+    pfi.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_filename")
+    parser.add_argument("index_filename")
+    parser.add_argument("--libspookyhash-path",
+                        help="Compiled hash library; pure Python if omitted")
+    parser.add_argument("--num-samples", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--use-mmap", action="store_true",
+                        help="Memory-map the path and index files")
+    parser.add_argument("--bloom-filename",
+                        help="Bloom filter of the path file's keys")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(parse_args())